@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import sys
+import io
+import json
+import random
+import shutil
+import tempfile
+import contextlib
+
+import extract_stats
+import key_engine
+import save_archive
+import synth_image
+
+
+stageNames = ["open", "read", "sd_decrypt", "sd_decrypt.readAhead",
+              "difi.unwrap", "difi.unwrapDPFS", "difi.unwrapIVFC",
+              "savefilesystem.FAT", "savefilesystem.getDirList",
+              "savefilesystem.getFileList", "savefilesystem.verifyHashTable",
+              "extractAll", "dumpFile", "difi.unwrapStream",
+              "difi.verifyStream", "difi.waitStream"]
+
+sdSaveId = 0x0004000000164800
+
+
+def getSdSavePath(saveId):
+    return "/title/%08x/%08x/data/00000001.sav" % (saveId >> 32,
+                                                   saveId & 0xFFFFFFFF)
+
+
+def benchDisa(filePath, outputDir, threadCount, key=None):
+    """ Extracts a save like disa-extract.py, decrypting it if key is given
+    """
+    if key is None:
+        saveType, saveId, keySession = None, None, None
+    else:
+        saveType, saveId = "sd", sdSaveId
+        keySession = key_engine.KeySession(None)
+        keySession.keySdDecrypt = key
+    with extract_stats.stage("open"):
+        archive = save_archive.openDisa(filePath, saveType, saveId,
+                                        key is not None, keySession,
+                                        threadCount)
+    extractArchive(archive, outputDir)
+
+
+def benchExtdata(extdataDir, outputDir, threadCount):
+    """ Extracts extdata like diff-extract.py
+
+     The subfiles are unwrapped by extractAll.
+    """
+    with extract_stats.stage("open"):
+        archive = save_archive.openExtdata(extdataDir,
+                                           threadCount=threadCount)
+    extractArchive(archive, outputDir)
+
+
+def benchTitleDb(filePath, outputDir, threadCount):
+    with extract_stats.stage("open"):
+        archive = save_archive.openTitleDbDiff(filePath,
+                                               threadCount=threadCount)
+    extractArchive(archive, outputDir)
+
+
+def extractArchive(archive, outputDir):
+    with archive:
+        archive.printDirList()
+        archive.printFileList()
+        archive.verify()
+        with extract_stats.stage("extractAll"):
+            archive.extractAll(outputDir)
+        archive.fat.allVisited()
+
+
+def checkOutput(outputDir, files):
+    """ Counts the generated files that were not extracted as they are """
+    mismatches = 0
+    for path, content in files.items():
+        try:
+            with open(os.path.join(outputDir, path.lstrip('/')), 'rb') as file:
+                if file.read() != content:
+                    mismatches += 1
+        except OSError:
+            mismatches += 1
+    return mismatches
+
+
+def generateScenarios(workDir, config):
+    """ Writes the synthetic containers
+
+     Returns {scenario: (bench function, input path, expected files, SD key)}.
+    """
+    rng = random.Random(config["seed"])
+    fsOptions = {"blockSize": config["blockSize"],
+                 "fragment": config["fragment"]}
+    selector = config["selector"]
+    # Poisoned blocks are picked among the level 4 blocks that the files
+    # are expected to fill; ones past the end of the partition are ignored.
+    expectedBlocks = max(config["poison"],
+                         config["files"] * config["maxSize"] // 2 // 0x1000)
+    poison = sorted(rng.sample(range(expectedBlocks), config["poison"]))
+
+    def getFiles():
+        return synth_image.randomFiles(rng, config["files"], config["maxSize"])
+
+    scenarios = {}
+
+    files = getFiles()
+    path = os.path.join(workDir, "save.sav")
+    with open(path, 'wb') as file:
+        file.write(synth_image.buildDisa(rng, files, selector=selector,
+                                         **fsOptions))
+    scenarios["disa"] = (benchDisa, path, files, None)
+
+    files = getFiles()
+    path = os.path.join(workDir, "save-data.sav")
+    with open(path, 'wb') as file:
+        file.write(synth_image.buildDisa(rng, files, hasData=True,
+                                         selector=selector, poison=poison,
+                                         **fsOptions))
+    scenarios["disa-partition-b"] = (benchDisa, path,
+                                     None if poison else files, None)
+
+    files = getFiles()
+    key = rng.randbytes(0x10)
+    path = os.path.join(workDir, "save-sd.sav")
+    with open(path, 'wb') as file:
+        file.write(synth_image.encryptSdFile(
+            synth_image.buildDisa(rng, files, selector=selector,
+                                  **fsOptions), key, getSdSavePath(sdSaveId)))
+    scenarios["disa-sd"] = (benchDisa, path, files, key)
+
+    files = getFiles()
+    path = os.path.join(workDir, "extdata")
+    synth_image.writeExtdata(rng, path, files, selector=selector,
+                             **fsOptions)
+    scenarios["extdata"] = (benchExtdata, path, files, None)
+
+    titles = synth_image.randomTitles(rng, config["files"], config["maxSize"])
+    path = os.path.join(workDir, "title.db")
+    with open(path, 'wb') as file:
+        file.write(synth_image.buildTitleDb(rng, titles, "NAND",
+                                            selector=selector, **fsOptions))
+    scenarios["titledb"] = (benchTitleDb, path, {
+        "%016X" % titleId: content for titleId, content in titles.items()},
+        None)
+
+    return scenarios
+
+
+def runScenario(scenario, outputDir, threadCount, repeatCount):
+    """ Runs a scenario repeatCount times and keeps the best time per stage
+
+     The stages are the ones recorded by extract_stats, plus "open" around
+     the whole opening of the container and "extractAll".
+    """
+    benchFunction, path, files, key = scenario
+    best = {}
+    for _ in range(repeatCount):
+        shutil.rmtree(outputDir, ignore_errors=True)
+        os.makedirs(outputDir)
+        extract_stats.takeStages()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if key is not None:
+                benchFunction(path, outputDir, threadCount, key)
+            else:
+                benchFunction(path, outputDir, threadCount)
+        for name, entry in extract_stats.takeStages().items():
+            seconds = entry["wallTime"]
+            best[name] = min(best.get(name, seconds), seconds)
+
+    mismatches = None if files is None else checkOutput(outputDir, files)
+    return best, mismatches
+
+
+def checkTruncated(scenario, outputDir, workDir, count):
+    """ Extracts count copies of the container of a scenario cut short
+
+     The copies are cut at sizes spread over the file (for extdata, the VSXE
+     subfile). Each one must raise ArchiveError, unless only padding after
+     the partitions was cut and every file is still extracted as it is.
+     Returns a description of each copy that did otherwise.
+    """
+    if count == 0:
+        return []
+    benchFunction, path, files, key = scenario
+    truncatedPath = os.path.join(workDir, "truncated")
+    if os.path.isdir(truncatedPath):
+        shutil.rmtree(truncatedPath)
+    elif os.path.exists(truncatedPath):
+        os.remove(truncatedPath)
+    if os.path.isdir(path):
+        shutil.copytree(path, truncatedPath)
+        innerPath = os.path.join("00000000", "00000001")
+        source = os.path.join(path, innerPath)
+        target = os.path.join(truncatedPath, innerPath)
+    else:
+        source = path
+        target = truncatedPath
+    with open(source, 'rb') as file:
+        original = file.read()
+
+    failures = []
+    for i in range(count):
+        size = len(original) * i // count
+        with open(target, 'wb') as file:
+            file.write(original[:size])
+        shutil.rmtree(outputDir, ignore_errors=True)
+        os.makedirs(outputDir)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                if key is not None:
+                    benchFunction(truncatedPath, outputDir, 1, key)
+                else:
+                    benchFunction(truncatedPath, outputDir, 1)
+        except save_archive.ArchiveError:
+            continue
+        except Exception as e:
+            failures.append("cut at 0x%X: %s: %s" % (size, type(e).__name__, e))
+            continue
+        if files is None or checkOutput(outputDir, files):
+            failures.append("cut at 0x%X: no ArchiveError" % size)
+    extract_stats.takeStages()
+    return failures
+
+
+def compareBaseline(baseline, results, tolerance):
+    """ Prints the stages that got slower than the baseline
+
+     A stage regresses if it takes more than (1 + tolerance) times its
+     baseline time and at least 1 ms more. Returns the regression count.
+    """
+    regressionCount = 0
+    for scenario, stages in sorted(results["scenarios"].items()):
+        baseStages = baseline["scenarios"].get(scenario, {})
+        for name, seconds in sorted(stages.items()):
+            baseSeconds = baseStages.get(name)
+            if baseSeconds is None:
+                continue
+            if seconds > baseSeconds * (1 + tolerance) and \
+                    seconds - baseSeconds >= 0.001:
+                print("Warning: %s %s regressed: %.4fs -> %.4fs (%+.0f%%)" % (
+                    scenario, name, baseSeconds, seconds,
+                    (seconds / baseSeconds - 1) * 100))
+                regressionCount += 1
+    return regressionCount
+
+
+def main():
+    if len(sys.argv) >= 2 and sys.argv[1] in ("-h", "-help", "--help"):
+        print("Usage: %s [OPTIONS]" % sys.argv[0])
+        print("")
+        print("Generates synthetic DISA, extdata and title database files and times each")
+        print("extraction stage on them, as recorded by extract_stats.py")
+        print("Options")
+        print("  -files N         Number of files per container (default 64)")
+        print("  -max-size N      Maximum file size in bytes (default 262144)")
+        print("  -block-size N    Filesystem block size (default 512)")
+        print("  -fragment        Allocate files in scattered blocks")
+        print("  -selector P      DPFS selector pattern: random, runs, zero or one")
+        print("                   (default random)")
+        print("  -poison N        Corrupt N IVFC level 4 blocks of partition B")
+        print("                   (default 0)")
+        print("  -seed N          Random seed (default 0)")
+        print("  -repeat N        Runs per container; the best time is kept (default 3)")
+        print("  -threads N       Number of threads for SD decryption and IVFC hash")
+        print("                   verification. The SD save must then be decrypted on")
+        print("                   the thread pool, or the run fails")
+        print("  -write DIR       Write the generated files to DIR and keep them")
+        print("  -baseline FILE   Compare the results to a JSON baseline and exit with")
+        print("                   1 if a stage regressed")
+        print("  -tolerance X     Allowed slowdown against the baseline (default 0.2)")
+        print("  -save FILE       Write the results as a JSON baseline")
+        print("  -truncate N      Also extract N copies of each container cut short, and")
+        print("                   exit with 1 unless they raise ArchiveError (default 0)")
+        exit(1)
+
+    config = {"files": 64, "maxSize": 0x40000, "blockSize": 0x200,
+              "fragment": False, "selector": "random", "poison": 0,
+              "seed": 0}
+    repeatCount = 3
+    threadCount = 1
+    workDir = None
+    baselinePath = None
+    tolerance = 0.2
+    savePath = None
+    truncateCount = 0
+
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == "-files":
+            i += 1
+            config["files"] = int(sys.argv[i])
+        elif sys.argv[i] == "-max-size":
+            i += 1
+            config["maxSize"] = int(sys.argv[i], 0)
+        elif sys.argv[i] == "-block-size":
+            i += 1
+            config["blockSize"] = int(sys.argv[i], 0)
+        elif sys.argv[i] == "-fragment":
+            config["fragment"] = True
+        elif sys.argv[i] == "-selector":
+            i += 1
+            config["selector"] = sys.argv[i]
+        elif sys.argv[i] == "-poison":
+            i += 1
+            config["poison"] = int(sys.argv[i])
+        elif sys.argv[i] == "-seed":
+            i += 1
+            config["seed"] = int(sys.argv[i])
+        elif sys.argv[i] == "-repeat":
+            i += 1
+            repeatCount = int(sys.argv[i])
+        elif sys.argv[i] == "-threads":
+            i += 1
+            threadCount = int(sys.argv[i])
+        elif sys.argv[i] == "-write":
+            i += 1
+            workDir = sys.argv[i]
+        elif sys.argv[i] == "-baseline":
+            i += 1
+            baselinePath = sys.argv[i]
+        elif sys.argv[i] == "-tolerance":
+            i += 1
+            tolerance = float(sys.argv[i])
+        elif sys.argv[i] == "-save":
+            i += 1
+            savePath = sys.argv[i]
+        elif sys.argv[i] == "-truncate":
+            i += 1
+            truncateCount = int(sys.argv[i])
+        else:
+            print("Error: unknown option %s" % sys.argv[i])
+            exit(1)
+        i += 1
+
+    if config["selector"] not in ("random", "runs", "zero", "one"):
+        print("Error: unknown selector pattern %s" % config["selector"])
+        exit(1)
+
+    baseline = None
+    if baselinePath is not None:
+        with open(baselinePath, 'r') as file:
+            baseline = json.load(file)
+        if baseline["config"] != config:
+            print("Warning: the baseline was made with other options %s" %
+                  json.dumps(baseline["config"]))
+
+    # Memory tracing would slow down every allocation being timed
+    extract_stats.enable(traceMemory=False)
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        if workDir is None:
+            workDir = os.path.join(tempDir, "input")
+        os.makedirs(workDir, exist_ok=True)
+        print("Generating synthetic files in %s" % workDir)
+        scenarios = generateScenarios(workDir, config)
+
+        results = {"config": config, "scenarios": {}}
+        failed = False
+        for name, scenario in scenarios.items():
+            stages, mismatches = runScenario(
+                scenario, os.path.join(tempDir, "output"), threadCount,
+                repeatCount)
+            results["scenarios"][name] = stages
+            print("%s:" % name)
+            for stage in stageNames:
+                if stage in stages:
+                    print("  %-31s %9.4fs" % (stage, stages[stage]))
+            if mismatches:
+                print("Error: %s: %d files extracted wrong" %
+                      (name, mismatches))
+                failed = True
+            if scenario[3] is not None and threadCount > 1 and \
+                    "sd_decrypt.readAhead" not in stages:
+                print("Error: %s: SD decryption did not use the thread pool" %
+                      name)
+                failed = True
+            for failure in checkTruncated(scenario,
+                                          os.path.join(tempDir, "output"),
+                                          tempDir, truncateCount):
+                print("Error: %s: %s" % (name, failure))
+                failed = True
+
+    if savePath is not None:
+        with open(savePath, 'w') as file:
+            json.dump(results, file, indent=1, sort_keys=True)
+
+    if baseline is not None:
+        regressionCount = compareBaseline(baseline, results, tolerance)
+        print("Info: %d stages regressed" % regressionCount)
+        if regressionCount != 0:
+            failed = True
+
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
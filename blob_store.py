@@ -0,0 +1,94 @@
+import hashlib
+import os
+import os.path
+import shutil
+import tempfile
+
+import savefilesystem
+
+
+class BlobStore(object):
+    """ Content-addressed store for extracted files
+
+     Each distinct content is stored once, as a read-only file named after
+     its SHA-256 under the store directory. Extracted files are hardlinks to
+     it, so identical files across saves and runs take space and write I/O
+     only once. The content is hashed from the image before anything is
+     written, so a known blob is never written again. Where a hardlink
+     cannot be made (e.g. the output is on another file system), the blob
+     is copied instead.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def getBlobPath(self, digest):
+        return os.path.join(self.path, digest[0:2], digest[2:])
+
+    def putRanges(self, data, ranges):
+        """ Stores (offset, size) ranges of data as one blob and gets its digest
+        """
+        digest = hashlib.sha256()
+        for pos, size in ranges:
+            digest.update(data[pos: pos + size])
+        digest = digest.hexdigest()
+
+        blobPath = self.getBlobPath(digest)
+        if not os.path.exists(blobPath):
+            os.makedirs(os.path.dirname(blobPath), exist_ok=True)
+            fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(blobPath),
+                                            prefix=".tmp")
+            with os.fdopen(fd, 'wb') as blob:
+                savefilesystem.writeRanges(blob, data, ranges)
+            os.chmod(tempPath, 0o444)
+            os.replace(tempPath, blobPath)  # atomic if another job races us
+        return digest
+
+    def put(self, data):
+        return self.putRanges(data, [(0, len(data))])
+
+    def putChunks(self, chunks):
+        """ Stores the content of an iterable of chunks and gets its digest
+
+         The content is only known after it is written, so it is written to
+         a temporary file while it is hashed, which is dropped if the blob
+         exists already.
+        """
+        digest = hashlib.sha256()
+        fd, tempPath = tempfile.mkstemp(dir=self.path, prefix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as blob:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    blob.write(chunk)
+            digest = digest.hexdigest()
+            blobPath = self.getBlobPath(digest)
+            if os.path.exists(blobPath):
+                os.remove(tempPath)
+            else:
+                os.makedirs(os.path.dirname(blobPath), exist_ok=True)
+                os.chmod(tempPath, 0o444)
+                os.replace(tempPath, blobPath)
+        except BaseException:
+            if os.path.lexists(tempPath):
+                os.remove(tempPath)
+            raise
+        return digest
+
+    def link(self, digest, file):
+        """ Makes the output file opened as file a hardlink to a blob
+
+         file has just been created by extractAll; it is replaced by the
+         link, or filled with a copy of the blob if linking fails.
+        """
+        blobPath = self.getBlobPath(digest)
+        tempPath = "%s.%d.tmp" % (file.name, os.getpid())
+        try:
+            os.link(blobPath, tempPath)
+            os.replace(tempPath, file.name)
+        except OSError:
+            if os.path.lexists(tempPath):
+                os.remove(tempPath)
+            with open(blobPath, 'rb') as blob:
+                shutil.copyfileobj(blob, file)
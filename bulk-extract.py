@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import re
+import sys
+import io
+import json
+import contextlib
+import concurrent.futures
+
+import blob_store
+import extract_stats
+import ivfc_cache
+import key_engine
+import save_archive
+
+try:
+    from secrets import Secrets
+except Exception as e:
+    print(f"Warning: error with secrets.py. CMAC verification is disabled. ({e})")
+    class Secrets(object):
+        pass
+
+
+HEX8 = "([0-9a-fA-F]{8})"
+sdSavePattern = re.compile(
+    "(?:^|/)title/%s/%s/data/[^/]+\\.sav$" % (HEX8, HEX8))
+sysdataPattern = re.compile("(?:^|/)sysdata/%s/[0-9a-fA-F]{8}$" % HEX8)
+extdataPattern = re.compile("(?:^|/)extdata/%s/%s$" % (HEX8, HEX8))
+dbPattern = re.compile("(?:^|/)dbs/([^/]+\\.db)$")
+
+
+def classify(relPath, isDir, isSd):
+    """ Works out how to extract a path of a dump
+
+     relPath uses '/' as separator. Returns (kind, save type, ID, decrypt),
+     or None if the path is not a container. kind is "disa", "extdata" or
+     "diff".
+    """
+    if isDir:
+        match = extdataPattern.search(relPath)
+        if match is None:
+            return None
+        saveId = (int(match.group(1), 16) << 32) | int(match.group(2), 16)
+        return ("extdata", "extdata", saveId, isSd)
+
+    match = sdSavePattern.search(relPath)
+    if match is not None and isSd:
+        saveId = (int(match.group(1), 16) << 32) | int(match.group(2), 16)
+        return ("disa", "sd", saveId, True)
+
+    match = sysdataPattern.search(relPath)
+    if match is not None and not isSd:
+        return ("disa", "nand", int(match.group(1), 16), False)
+
+    match = dbPattern.search(relPath)
+    if match is not None:
+        if not isSd:
+            # NAND title database CMAC verification is unimplemented
+            return ("diff", None, None, False)
+        dbIds = {"title.db": 2, "import.db": 3}
+        if match.group(1) in dbIds:
+            return ("diff", "titledb", dbIds[match.group(1)], True)
+
+    return None
+
+
+def scanTree(rootPath, forceSd=None):
+    """ Lists the containers in an SD or NAND dump
+
+     Unless forceSd is given, a path is treated as SD if it is inside a
+     "Nintendo 3DS" folder. Yields (path relative to the root, kind, save
+     type, ID, decrypt).
+    """
+    for dirPath, dirNames, fileNames in os.walk(rootPath):
+        dirNames.sort()
+        relDir = os.path.relpath(dirPath, rootPath).replace(os.sep, '/')
+        relDir = "" if relDir == "." else relDir + "/"
+        if forceSd is not None:
+            isSd = forceSd
+        else:
+            isSd = "nintendo 3ds" in relDir.lower().split('/') or \
+                os.path.basename(os.path.abspath(rootPath)).lower() == \
+                "nintendo 3ds"
+
+        extdataDirs = []
+        for name in dirNames:
+            kind = classify(relDir + name, True, isSd)
+            if kind is not None:
+                extdataDirs.append(name)
+                yield (relDir + name,) + kind
+        for name in extdataDirs:
+            dirNames.remove(name)  # subfiles are handled with the extdata
+
+        for name in sorted(fileNames):
+            kind = classify(relDir + name, False, isSd)
+            if kind is not None:
+                yield (relDir + name,) + kind
+
+
+jobKeySession = None
+
+
+def initJob(statsEnabled):
+    """ Sets up the key session and stats of a worker process """
+    global jobKeySession
+    jobKeySession = key_engine.KeySession(Secrets())
+    if statsEnabled:
+        extract_stats.enable()
+
+
+def extractContainer(inputPath, outputPath, kind, saveType, saveId, decrypt,
+                     threadCount, cache, store):
+    if kind == "disa":
+        if outputPath is not None:
+            os.makedirs(outputPath, exist_ok=True)
+        with save_archive.openDisa(inputPath, saveType, saveId, decrypt,
+                                   jobKeySession, threadCount,
+                                   cache=cache) as archive:
+            archive.printDirList()
+            archive.printFileList()
+            archive.verify()
+            print("Walking through files and dumping")
+            archive.extractAll(outputPath, store=store)
+            archive.fat.allVisited()
+    elif kind == "extdata":
+        if outputPath is not None:
+            os.makedirs(outputPath, exist_ok=True)
+        archive = save_archive.openExtdata(inputPath, saveId, decrypt,
+                                           jobKeySession, threadCount, cache)
+        archive.printDirList()
+        archive.printFileList()
+        archive.verify()
+        archive.fat.allVisited()
+        archive.extractAll(outputPath, store=store)
+    else:
+        diff = save_archive.openDiff(
+            inputPath, saveType=saveType, saveId=saveId, decrypt=decrypt,
+            keySession=jobKeySession, threadCount=threadCount,
+            cache=cache, stream=True)
+        if outputPath is not None:
+            os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+        save_archive.writeDiff(diff, outputPath, store)
+    print("Finished!")
+
+
+def newRecord(job):
+    """ Creates the manifest record of a job, without its outcome """
+    relPath, inputPath, outputPath, kind, saveType, saveId, decrypt = job[:7]
+    return {"path": relPath, "kind": kind, "saveType": saveType,
+            "id": None if saveId is None else "%X" % saveId,
+            "decrypt": decrypt, "output": outputPath}
+
+
+def failedRecord(job, error):
+    """ Creates the manifest record of a job whose worker failed """
+    record = newRecord(job)
+    line = "Error: worker failed: %s: %s" % (type(error).__name__, error)
+    record.update({"status": "error", "warnings": [], "errors": [line],
+                   "log": [line]})
+    return record
+
+
+def extractJob(job):
+    """ Extracts one container in a worker process
+
+     Returns its manifest record. The console output is kept in the record,
+     as well as the stages of the container if stats are enabled.
+    """
+    record = newRecord(job)
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        try:
+            extractContainer(*job[1:])
+            record["status"] = "ok"
+        except (save_archive.ArchiveError, OSError) as e:
+            print("Error: %s" % e)
+            record["status"] = "error"
+        except (Exception, SystemExit) as e:
+            # A malformed container must not stop the rest of the dump
+            print("Error: %s: %s" % (type(e).__name__, e))
+            record["status"] = "error"
+
+    lines = log.getvalue().splitlines()
+    record["warnings"] = [line for line in lines
+                          if line.startswith("Warning:")]
+    record["errors"] = [line for line in lines if line.startswith("Error:")]
+    record["log"] = lines
+    stages = extract_stats.takeStages()
+    if stages is not None:
+        record["stats"] = stages
+    return record
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: %s input [output] [OPTIONS]" % sys.argv[0])
+        print("")
+        print("Arguments:")
+        print("  input            The root of an SD card or a decrypted NAND dump")
+        print("  output           The directory for storing extracted files")
+        print("")
+        print("Saves (title/*/*/data/*.sav, sysdata/*/*), extdata (extdata/*/*) and")
+        print("databases (dbs/*.db) are found in the tree and extracted to the same")
+        print("relative paths in the output. Paths inside a \"Nintendo 3DS\" folder are")
+        print("SD files, which are decrypted. IDs are taken from the paths.")
+        print("Options")
+        print("  -jobs N          Number of containers extracted at once (default 1)")
+        print("  -threads N       Number of threads for decryption and IVFC hash")
+        print("                   verification per container (default 1)")
+        print("  -cache DIR       Remember IVFC verification results in DIR and skip")
+        print("                   hashing partitions that have been verified before")
+        print("  -manifest FILE   Where to write the JSON manifest of results")
+        print("                   (default output/manifest.json)")
+        print("  -store DIR       Store each distinct output file once in DIR, named after")
+        print("                   its SHA-256, and extract hardlinks to it")
+        print("  -stats FILE      Write the time, CPU time, bytes and peak memory of each")
+        print("                   stage to FILE as JSON (tracing memory slows the run down)")
+        print("  -profile FILE    Profile the run with cProfile and dump the result to FILE")
+        print("  -sd              Treat the whole input as SD files")
+        print("  -nand            Treat the whole input as NAND files")
+        exit(1)
+
+    inputPath = None
+    outputPath = None
+    jobCount = 1
+    threadCount = 1
+    cache = None
+    manifestPath = None
+    forceSd = None
+    store = None
+
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == "-jobs":
+            i += 1
+            jobCount = int(sys.argv[i])
+        elif sys.argv[i] == "-threads":
+            i += 1
+            threadCount = int(sys.argv[i])
+        elif sys.argv[i] == "-cache":
+            i += 1
+            cache = ivfc_cache.IVFCCache(sys.argv[i])
+        elif sys.argv[i] == "-manifest":
+            i += 1
+            manifestPath = sys.argv[i]
+        elif sys.argv[i] == "-store":
+            i += 1
+            store = blob_store.BlobStore(sys.argv[i])
+        elif sys.argv[i] == "-stats":
+            i += 1
+            extract_stats.enable(sys.argv[i])
+        elif sys.argv[i] == "-profile":
+            i += 1
+            extract_stats.enableProfile(sys.argv[i])
+        elif sys.argv[i] == "-sd":
+            forceSd = True
+        elif sys.argv[i] == "-nand":
+            forceSd = False
+        else:
+            if inputPath is None:
+                inputPath = sys.argv[i]
+            else:
+                outputPath = sys.argv[i]
+        i += 1
+
+    if inputPath is None:
+        print("Error: no input directory given.")
+        exit(1)
+
+    if outputPath is None:
+        print("No output directory given. Will only do data checking.")
+    elif manifestPath is None:
+        manifestPath = os.path.join(outputPath, "manifest.json")
+
+    jobs = []
+    for relPath, kind, saveType, saveId, decrypt in scanTree(inputPath, forceSd):
+        jobs.append((relPath, os.path.join(inputPath, relPath),
+                     None if outputPath is None
+                     else os.path.join(outputPath, relPath),
+                     kind, saveType, saveId, decrypt, threadCount, cache,
+                     store))
+    print("Info: %d containers found" % len(jobs))
+
+    records = []
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                jobCount, initializer=initJob,
+                initargs=(extract_stats.stats is not None,)) as executor:
+            futures = [executor.submit(extractJob, job) for job in jobs]
+            for job, future in zip(jobs, futures):
+                # A worker that dies or exits must only fail its own container
+                try:
+                    record = save_archive.getJobResult(
+                        future, extractJob, job, initJob,
+                        (extract_stats.stats is not None,))
+                except (Exception, SystemExit) as e:
+                    record = failedRecord(job, e)
+                extract_stats.mergeStages(record.get("stats"))
+                print("%s: %s, %d warnings" % (
+                    record["path"], record["status"], len(record["warnings"])))
+                for line in record["errors"]:
+                    print("  " + line)
+                records.append(record)
+    finally:
+        # Whatever was extracted before an interruption is still recorded
+        if manifestPath is not None:
+            if os.path.dirname(manifestPath):
+                os.makedirs(os.path.dirname(manifestPath), exist_ok=True)
+            with open(manifestPath, 'w') as manifest:
+                json.dump({"input": inputPath, "output": outputPath,
+                           "containers": records}, manifest, indent=1)
+
+    errorCount = sum(record["status"] != "ok" for record in records)
+    print("Info: %d extracted, %d failed" %
+          (len(records) - errorCount, errorCount))
+
+    if errorCount != 0:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
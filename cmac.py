@@ -6,7 +6,11 @@ except:
     from Crypto.Cipher import AES
 
 
+def AesCmacInit(key):
+    return CMAC.new(key, ciphermod=AES)
+
+
 def AesCmac(data, key):
-    cobj = CMAC.new(key, ciphermod=AES)
+    cobj = AesCmacInit(key)
     cobj.update(data)
     return cobj.digest()
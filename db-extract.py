@@ -1,131 +1,109 @@
 #!/usr/bin/env python3
 
-import os
-import struct
 import sys
 
-import savefilesystem
+import blob_store
+import extract_stats
+import ivfc_cache
+import key_engine
+import save_archive
+
+try:
+    from secrets import Secrets
+except Exception as e:
+    print(f"Warning: error with secrets.py. CMAC verification is disabled. ({e})")
+    class Secrets(object):
+        pass
 
 
 def main():
     if len(sys.argv) < 2:
-        print("Usage: %s input [output]" % sys.argv[0])
+        print("Usage: %s input [output] [OPTIONS]" % sys.argv[0])
+        print("")
+        print("Arguments:")
+        print("  input            A title database DIFF file (ticket.db, title.db, import.db")
+        print("                   etc.), or its content unwrapped by diff-extract.py")
+        print("  output           The directory for storing extracted files")
+        print("")
+        print("The following arguments are only used for a DIFF file on SD.")
+        print("You need to provide secrets.py to enable CMAC verification.")
+        print("  -id ID           The title database ID: 2 for title.db, 3 for import.db")
+        print("  -decrypt         Decrypt the DIFF file. Requires -id")
+        print("Options")
+        print("  -threads N       Number of threads for decryption and IVFC hash")
+        print("                   verification (default 1)")
+        print("  -cache DIR       Remember IVFC verification results in DIR and skip")
+        print("                   hashing partitions that have been verified before")
+        print("  -store DIR       Store each distinct output file once in DIR, named after")
+        print("                   its SHA-256, and extract hardlinks to it")
+        print("  -stats FILE      Write the time, CPU time, bytes and peak memory of each")
+        print("                   stage to FILE as JSON (tracing memory slows the run down)")
+        print("  -profile FILE    Profile the run with cProfile and dump the result to FILE")
         exit(1)
 
     inputPath = None
     outputPath = None
+    saveId = None
+    decrypt = False
+    threadCount = 1
+    cache = None
+    store = None
 
     i = 1
     while i < len(sys.argv):
-        if inputPath is None:
+        if sys.argv[i] == "-id":
+            i += 1
+            saveId = int(sys.argv[i], 16)
+        elif sys.argv[i] == "-decrypt":
+            decrypt = True
+        elif sys.argv[i] == "-threads":
+            i += 1
+            threadCount = int(sys.argv[i])
+        elif sys.argv[i] == "-cache":
+            i += 1
+            cache = ivfc_cache.IVFCCache(sys.argv[i])
+        elif sys.argv[i] == "-store":
+            i += 1
+            store = blob_store.BlobStore(sys.argv[i])
+        elif sys.argv[i] == "-stats":
+            i += 1
+            extract_stats.enable(sys.argv[i])
+        elif sys.argv[i] == "-profile":
+            i += 1
+            extract_stats.enableProfile(sys.argv[i])
+        elif inputPath is None:
             inputPath = sys.argv[i]
         else:
             outputPath = sys.argv[i]
         i += 1
 
-    if outputPath is None:
-        print("No output directory given. Will only do data checking.")
-
-    file = open(inputPath, 'rb')
-    magic, magic2, b, c = struct.unpack('<IIII', file.read(0x10))
-    if magic == 0x4B434954:
-        print("Info: magic = TICK")
-    elif magic == 0x444E414E:
-        print("Info: magic = NAND")
-        file.read(0x70)
-    elif magic == 0x504D4554:
-        print("Info: magic = TEMP")
-        file.read(0x70)
-    else:
-        print("Error: unknown magic")
+    if inputPath is None:
+        print("Error: no input file given.")
         exit(1)
 
-    print("Info: Pre Header 0x%08X 0x%08X 0x%08X" % (magic2, b, c))
-
-    dbri = file.read()
-    file.close()
-
-    BDRI, ver, filesystemHeaderOff, imageSize, imageBlockSize, x00 \
-        = struct.unpack('<IIQQII', dbri[0:0x20])
-
-    if BDRI != 0x49524442:
-        print("Error: Wrong BDRI magic")
-        exit(1)
+    if outputPath is None:
+        print("No output directory given. Will only do data checking.")
 
-    if ver != 0x00030000:
-        print("Error: Wrong BDRI version")
+    try:
+        # An encrypted DIFF cannot be recognized before it is decrypted
+        if decrypt or save_archive.isDiffFile(inputPath):
+            archive = save_archive.openTitleDbDiff(
+                inputPath, saveId, decrypt, key_engine.KeySession(Secrets()),
+                threadCount, cache)
+        else:
+            archive = save_archive.openTitleDb(inputPath)
+    except save_archive.ArchiveError as e:
+        print("Error: %s" % e)
         exit(1)
 
-    if x00 != 0:
-        print("Warning: unknown 0 = 0x%X in BDRI header" % x00)
-
-    fsHeader = savefilesystem.Header(
-        dbri[filesystemHeaderOff: filesystemHeaderOff+0x68], False)
-
-    dataRegion = dbri[
-        fsHeader.dataRegionOff: fsHeader.dataRegionOff +
-        fsHeader.dataRegionSize * fsHeader.blockSize]
-
-    # Parses hash tables
-    dirHashTable = savefilesystem.getHashTable(fsHeader.dirHashTableOff,
-                                               fsHeader.dirHashTableSize,
-                                               dbri)
-
-    fileHashTable = savefilesystem.getHashTable(fsHeader.fileHashTableOff,
-                                                fsHeader.fileHashTableSize,
-                                                dbri)
-
-    # Parses FAT
-    fat = savefilesystem.FAT(fsHeader, dbri)
-
-    # Parses directory & file entry table
-    dirList = savefilesystem.getTdbDirList(
-        fsHeader, dataRegion, fat)
-
-    print("Directory list:")
-    for i in range(len(dirList)):
-        dirList[i].printEntry(i)
-
-    fileList = savefilesystem.getTdbFileList(
-        fsHeader, dataRegion, fat)
-
-    print("File list:")
-    for i in range(len(fileList)):
-        fileList[i].printEntry(i)
-
-    # Verifies directory & file hash table
-    print("Verifying directory hash table")
-    savefilesystem.verifyHashTable(dirHashTable, dirList)
-    print("Verifying file hash table")
-    savefilesystem.verifyHashTable(fileHashTable, fileList)
-
-    # Walks through free blocks
-    print("Walking through free blocks")
-    fat.visitFreeBlock()
-
-    def saveFileDumper(fileEntry, file, _):
-        fileSize = fileEntry.size
-
-        def blockDumper(index):
-            nonlocal fileSize
-            if fileSize == 0:
-                print("Warning: excessive block")
-                return
-            tranSize = min(fileSize, fsHeader.blockSize)
-            pos = index * fsHeader.blockSize
-            if file is not None:
-                file.write(dataRegion[pos: pos + tranSize])
-            fileSize -= tranSize
-
-        if fileSize != 0:
-            fat.walk(fileEntry.blockIndex, blockDumper)
-        if fileSize != 0:
-            print("Warning: not enough block")
+    archive.printDirList()
+    archive.printFileList()
+    archive.verify()
 
     print("Walking through files and dumping")
-    savefilesystem.extractAll(dirList, fileList, outputPath, saveFileDumper)
+    archive.extractAll(outputPath, store=store)
 
-    fat.allVisited()
+    archive.fat.allVisited()
 
     print("Finished!")
 
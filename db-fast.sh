@@ -1,9 +1,3 @@
 #!/bin/bash
-pipe=$(mktemp -u)
-
-mkfifo $pipe
-
-./diff-extract.py $1 $pipe &
-./db-extract.py $pipe $2
-
-rm $pipe
+# db-extract.py now unwraps the DIFF file itself. Kept for compatibility
+exec "$(dirname "$0")/db-extract.py" "$@"
@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 
-import os
 import os.path
-import struct
 import sys
-import hashlib
-
-import difi
-import savefilesystem
+import io
+import contextlib
+import concurrent.futures
+
+import blob_store
+import extract_manifest
+import extract_stats
+import ivfc_cache
 import key_engine
+import save_archive
 
 try:
     from secrets import Secrets
@@ -18,224 +21,124 @@ except Exception as e:
         pass
 
 
-def cryptoUnwrap(diff, saveType, saveId, saveSubId, key):
-    if saveId is None:
-        print("Error: ID needed to decrypt the save.")
-        return None
-
-    if key is None:
-        print("No enough secrets provided to decrypt.")
-        return None
-
-    if saveType is None:
-        print("Error: save type needed to decrypt the save.")
-        return None
-    elif saveType == "extdata":
-        if saveSubId is None:
-            print("Error: sub ID needed to decrypt the save.")
-            return None
-        high = saveId >> 32
-        low = saveId & 0xFFFFFFFF
-        subHigh = saveSubId >> 32
-        subLow = saveSubId & 0xFFFFFFFF
-        path = "/extdata/%08x/%08x/%08x/%08x" % (high, low, subHigh, subLow)
-    elif saveType == "titledb":
-        if saveId == 2:
-            fileName = "title.db"
-        elif saveId == 3:
-            fileName = "import.db"
-        path = "/dbs/" + fileName
-
-    import sd_decrypt
-    return sd_decrypt.DecryptSdFile(diff, path, key)
-
-
-def unwrapDIFF(filePath, expectedUniqueId=None, saveType=None, saveId=None,
-               saveSubId=None, decrypt=False):
-    diff = open(filePath, 'rb')
-
-    secretsDb = Secrets()
-    keyEngine = key_engine.KeyEngine(secretsDb)
-
-    if decrypt:
-        diff = cryptoUnwrap(diff, saveType, saveId,
-                            saveSubId, keyEngine.getKeySdDecrypt())
-        if diff is None:
-            exit(1)
+jobKeySession = None
+
+
+def initSubfileJob(statsEnabled):
+    """ Sets up the key session and stats of a subfile worker process """
+    global jobKeySession
+    jobKeySession = key_engine.KeySession(Secrets())
+    if statsEnabled:
+        extract_stats.enable()
+
+
+def extractSubfileJob(job):
+    """ Unwraps one extdata subfile in a worker process and writes it out
+
+     Returns whether the subfile was extracted, the console output of the
+     job, which the parent prints in order, and the stages it recorded if
+     stats are enabled.
+    """
+    subfilePath, outputPath, uniqueId, saveId, saveSubId, decrypt, \
+        threadCount, cache, store = job
+    log = io.StringIO()
+    extracted = False
+    with contextlib.redirect_stdout(log):
+        try:
+            subfile = save_archive.openDiff(
+                subfilePath, expectedUniqueId=uniqueId, saveType="extdata",
+                saveId=saveId, saveSubId=saveSubId, decrypt=decrypt,
+                keySession=jobKeySession, threadCount=threadCount,
+                cache=cache, stream=True)
+            save_archive.writeDiff(subfile, outputPath, store)
+            extracted = True
+        except save_archive.ArchiveError as e:
+            print("Error: %s" % e)
+            print("Error: subfile not extracted")
+        except (Exception, SystemExit) as e:
+            # A broken subfile must not stop the other jobs
+            print("Error: %s: %s" % (type(e).__name__, e))
+            print("Error: subfile not extracted")
+    return extracted, log.getvalue(), extract_stats.takeStages()
+
+
+def extractExtdata(extdataDir, outputDir, saveId, decrypt, threadCount=1,
+                   cache=None, keySession=None, jobCount=1, incremental=False,
+                   store=None):
+    manifest = None
+    if incremental and outputDir is not None:
+        manifest = extract_manifest.ExtractManifest(
+            os.path.join(outputDir, ".extract-manifest.json"), outputDir)
+        container = {"extdata": extract_manifest.getExtdataDigest(extdataDir)}
+        if manifest.isContainerUnchanged(container):
+            print("Info: extdata unchanged since the last extraction. Skipped.")
+            print("Finished!")
+            return
+
+    archive = save_archive.openExtdata(extdataDir, saveId, decrypt,
+                                       keySession, threadCount, cache)
+
+    archive.printDirList()
+    archive.printFileList()
+    archive.verify()
+
+    archive.fat.allVisited()
+
+    jobs = []
 
-    key = keyEngine.getKeySdNandCmac()
-
-    Cmac = diff.read(0x10)
-    diff.seek(0x100, os.SEEK_SET)
-    header = diff.read(0x100)
-
-    digestBlock = None
-    if key is None:
-        print("No enough secrets provided. Will skip CMAC verification.")
-    elif saveType is None:
-        print("No save type specified. Will skip CMAC verification.")
-    elif saveId is None:
-        print("No save ID specified. Will skip CMAC verification.")
-    elif saveType == "extdata":
-        if saveSubId is None:
-            saveSubId = 0
-            quotaFlag = 0
-        else:
-            quotaFlag = 1
-        digestBlock = b"CTR-EXT0" + \
-            struct.pack("<QIQ", saveId, quotaFlag, saveSubId) + header
-    elif saveType == "titledb":
-        digestBlock = b"CTR-9DB0" + struct.pack("<I", saveId) + header
+    def extFileDumper(fileEntry, file, index):
+        # Deferred to the process pool. The output file is reopened by name
+        idHigh, idLow = archive.getSubfileId(index)
+        jobs.append((fileEntry.getName(), (
+            archive.getSubfilePath(idHigh, idLow),
+            file.name if file is not None else None,
+            fileEntry.uniqueId, saveId, (idHigh << 32) | idLow, decrypt,
+            threadCount, cache, store)))
+
+    if jobCount > 1:
+        archive.extractAll(outputDir, extFileDumper, manifest)
     else:
-        print("Unknown save type. Will skip CMAC verification.")
-
-    if digestBlock is not None:
-        import cmac
-        if Cmac != cmac.AesCmac(hashlib.sha256(digestBlock).digest(), key):
-            print("Error: CMAC mismatch.")
+        archive.extractAll(outputDir, manifest=manifest, store=store)
+
+    if jobs:
+        report = []
+        with concurrent.futures.ProcessPoolExecutor(
+                jobCount, initializer=initSubfileJob,
+                initargs=(extract_stats.stats is not None,)) as executor:
+            futures = [executor.submit(extractSubfileJob, job)
+                       for _, job in jobs]
+            for (name, job), future in zip(jobs, futures):
+                # A worker that dies or exits must only fail its own subfile
+                try:
+                    extracted, log, stages = save_archive.getJobResult(
+                        future, extractSubfileJob, job, initSubfileJob,
+                        (extract_stats.stats is not None,))
+                except (Exception, SystemExit) as e:
+                    extracted, stages = False, None
+                    log = "Error: worker failed: %s: %s\n" % (
+                        type(e).__name__, e)
+                extract_stats.mergeStages(stages)
+                print("Extracting %s" % name)
+                print(log, end="")
+                for line in log.splitlines():
+                    if line.startswith("Warning:") or line.startswith("Error:"):
+                        report.append("%s: %s" % (name, line))
+                outputPath = job[1]
+                if not extracted and outputPath is not None and \
+                        os.path.lexists(outputPath):
+                    # Don't leave the placeholder looking like an empty file
+                    os.remove(outputPath)
+
+        print("Warning report:")
+        if not report:
+            print("  (none)")
+        for line in report:
+            print("  " + line)
+        if any(": Error:" in line for line in report):
             exit(1)
-        else:
-            print("Info: CMAC verified.")
-
-    DIFF, ver, \
-        secPartTableOff, priPartTableOff, partTableSize, \
-        partOff, partSize, \
-        activeTable, tableHash, uniqueId, \
-        = struct.unpack('<IIQQQQQI32sQ164x', header)
-
-    if DIFF != 0x46464944:
-        print("Error: Not a DIFF format")
-        exit(1)
-
-    if ver != 0x00030000:
-        print("Error: Wrong DIFF version")
-        exit(1)
-
-    if activeTable == 0:
-        partTableOff = priPartTableOff
-    elif activeTable == 1:
-        partTableOff = secPartTableOff
-    else:
-        print("Error: Wrong active table ID %d" % activeTable)
-        exit(1)
-
-    print("Info: Unique ID = %016X" % uniqueId)
-    if expectedUniqueId is not None:
-        if expectedUniqueId != uniqueId:
-            print("Warning: unique ID mismatch")
-
-    # Verify partition table hash
-    diff.seek(partTableOff, os.SEEK_SET)
-    partTable = diff.read(partTableSize)
-    if hashlib.sha256(partTable).digest() != tableHash:
-        print("Error: Partition table hash mismatch!")
-        exit(1)
-
-    # Reads and unwraps partition
-    diff.seek(partOff, os.SEEK_SET)
-    part = diff.read(partSize)
-    image, externalIVFCL4 = difi.unwrap(partTable, part)
-    if externalIVFCL4:
-        print("Info: external IVFC level 4")
-
-    diff.close()
-    return image
-
-
-def trimBytes(bs):
-    """ Trims trailing zeros in a byte string """
-    n = bs.find(b'\0')
-    if n != -1:
-        return bs[:n]
-    return bs
-
-
-def extractExtdata(extdataDir, outputDir, saveId, decrypt):
-    def extdataFileById(idHigh, idLow):
-        return os.path.join(extdataDir, "%08x" % idHigh, "%08x" % idLow)
-    vsxe = unwrapDIFF(extdataFileById(0, 1), saveType="extdata",
-                      saveId=saveId, saveSubId=1, decrypt=decrypt)
-    # Reads VSXE header
-    VSXE, ver, filesystemHeaderOff, imageSize, imageBlockSize, x00, \
-        unk1, recentAction, unk2, recentId, unk3, recentPath \
-        = struct.unpack('<IIQQIIQIIII256s', vsxe[0:0x138])
-
-    if VSXE != 0x45585356:
-        print("Error: Wrong VSXE magic")
-        exit(1)
-
-    if ver != 0x00030000:
-        print("Error: Wrong VSXE version")
-        exit(1)
-
-    if x00 != 0:
-        print("Warning: unknown 0 = 0x%X in VSXE header" % x00)
 
-    print("Info: unk1 = %d" % unk1)
-    print("Info: recent action = %d" % recentAction)
-    print("Info: unk2 = %d" % unk2)
-    print("Info: recent ID = %d" % recentId)
-    print("Info: unk3 = %d" % unk3)
-    print("Info: recentPath = %s" % trimBytes(recentPath).decode())
-
-    fsHeader = savefilesystem.Header(
-        vsxe[filesystemHeaderOff:filesystemHeaderOff + 0x68], False)
-
-    dataRegion = vsxe[
-        fsHeader.dataRegionOff: fsHeader.dataRegionOff +
-        fsHeader.dataRegionSize * fsHeader.blockSize]
-
-    # parse FAT
-    fat = savefilesystem.FAT(fsHeader, vsxe)
-
-    # parse hash tables
-    dirHashTable = savefilesystem.getHashTable(fsHeader.dirHashTableOff,
-                                               fsHeader.dirHashTableSize,
-                                               vsxe)
-
-    fileHashTable = savefilesystem.getHashTable(fsHeader.fileHashTableOff,
-                                                fsHeader.fileHashTableSize,
-                                                vsxe)
-
-    # Parses directory & file entry table
-    dirList = savefilesystem.getDirList(
-        fsHeader, vsxe, dataRegion, fat)
-
-    print("Directory list:")
-    for i in range(len(dirList)):
-        dirList[i].printEntry(i)
-
-    fileList = savefilesystem.getFileList(
-        fsHeader, vsxe, dataRegion, fat)
-
-    print("File list:")
-    for i in range(len(fileList)):
-        fileList[i].printEntryAsExtdata(i)
-
-    # Verifies directory & file hash table
-    print("Verifying directory hash table")
-    savefilesystem.verifyHashTable(dirHashTable, dirList)
-    print("Verifying file hash table")
-    savefilesystem.verifyHashTable(fileHashTable, fileList)
-
-    # Walks through free blocks
-    print("Walking through free blocks")
-    fat.visitFreeBlock()
-
-    fat.allVisited()
-
-    def extFileDumper(fileEntry, file, index):
-        print("Extracting %s" % fileEntry.getName())
-        fileId = index + 1
-        dirCapacity = 126  # ???
-        idHigh = fileId // dirCapacity
-        idLow = fileId % dirCapacity
-        content = unwrapDIFF(extdataFileById(idHigh, idLow), expectedUniqueId=fileEntry.uniqueId,
-                             saveType="extdata", saveId=saveId, saveSubId=(idHigh << 32) | idLow, decrypt=decrypt)
-        if file is not None:
-            file.write(content)
-
-    savefilesystem.extractAll(dirList, fileList, outputDir, extFileDumper)
+    if manifest is not None:
+        manifest.save(container)
 
     print("Finished!")
 
@@ -261,6 +164,19 @@ def main():
         print("  -decrypt         Decrypt SD save. Requires -extdata or -titledb options unless")
         print("                   a extdata directory is given as the input. -id is also required")
         print("                   -subid is required for single extdata file")
+        print("Other options")
+        print("  -threads N       Number of threads for decryption and IVFC hash")
+        print("                   verification (default 1)")
+        print("  -cache DIR       Remember IVFC verification results in DIR and skip")
+        print("                   hashing partitions that have been verified before")
+        print("  -jobs N          Number of processes extracting extdata subfiles (default 1)")
+        print("  -incremental     Keep a manifest next to the output, skip the input if it")
+        print("                   is unchanged and only rewrite changed extdata files")
+        print("  -store DIR       Store each distinct output file once in DIR, named after")
+        print("                   its SHA-256, and extract hardlinks to it")
+        print("  -stats FILE      Write the time, CPU time, bytes and peak memory of each")
+        print("                   stage to FILE as JSON (tracing memory slows the run down)")
+        print("  -profile FILE    Profile the run with cProfile and dump the result to FILE")
         exit(1)
 
     inputPath = None
@@ -269,6 +185,11 @@ def main():
     saveSubId = None
     saveType = None
     decrypt = False
+    threadCount = 1
+    cache = None
+    jobCount = 1
+    incremental = False
+    store = None
 
     i = 1
     while i < len(sys.argv):
@@ -284,6 +205,26 @@ def main():
             saveType = "titledb"
         elif sys.argv[i] == "-decrypt":
             decrypt = True
+        elif sys.argv[i] == "-threads":
+            i += 1
+            threadCount = int(sys.argv[i])
+        elif sys.argv[i] == "-cache":
+            i += 1
+            cache = ivfc_cache.IVFCCache(sys.argv[i])
+        elif sys.argv[i] == "-jobs":
+            i += 1
+            jobCount = int(sys.argv[i])
+        elif sys.argv[i] == "-incremental":
+            incremental = True
+        elif sys.argv[i] == "-store":
+            i += 1
+            store = blob_store.BlobStore(sys.argv[i])
+        elif sys.argv[i] == "-stats":
+            i += 1
+            extract_stats.enable(sys.argv[i])
+        elif sys.argv[i] == "-profile":
+            i += 1
+            extract_stats.enableProfile(sys.argv[i])
         else:
             if inputPath is None:
                 inputPath = sys.argv[i]
@@ -298,17 +239,38 @@ def main():
     if outputPath is None:
         print("No output directory given. Will only do data checking.")
 
-    if os.path.isdir(inputPath):
-        extractExtdata(inputPath, outputPath, saveId, decrypt)
-        exit(0)
+    keySession = key_engine.KeySession(Secrets())
+
+    try:
+        if os.path.isdir(inputPath):
+            extractExtdata(inputPath, outputPath, saveId, decrypt,
+                           threadCount, cache, keySession, jobCount,
+                           incremental, store)
+            exit(0)
+
+        manifest = None
+        if incremental and outputPath is not None:
+            manifest = extract_manifest.ExtractManifest(
+                outputPath + ".extract-manifest.json",
+                os.path.dirname(outputPath))
+            container = {"header": extract_manifest.getHeaderDigest(inputPath)}
+            if manifest.isContainerUnchanged(container):
+                print("Info: file unchanged since the last extraction. Skipped.")
+                exit(0)
+
+        diff = save_archive.openDiff(
+            inputPath, saveType=saveType, saveId=saveId, saveSubId=saveSubId,
+            decrypt=decrypt, keySession=keySession, threadCount=threadCount,
+            cache=cache, stream=True)
+    except save_archive.ArchiveError as e:
+        print("Error: %s" % e)
+        exit(1)
 
-    image = unwrapDIFF(inputPath, saveType=saveType,
-                       saveId=saveId, saveSubId=saveSubId, decrypt=decrypt)
+    save_archive.writeDiff(diff, outputPath, store)
 
-    if outputPath is not None:
-        output_file = open(outputPath, "wb")
-        output_file.write(image)
-        output_file.close()
+    if manifest is not None:
+        manifest.addFile(os.path.basename(outputPath), {"size": diff.size})
+        manifest.save(container)
 
 
 if __name__ == "__main__":
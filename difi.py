@@ -2,13 +2,25 @@
 
 import struct
 import hashlib
+import concurrent.futures
+import copy
+import bisect
+import collections
+import re
+
+import extract_stats
+
+
+class DifiError(Exception):
+    """ Raised when a partition discriptor is malformed """
 
 
 class PartDiscriptor(object):
     """ Partition discriptor
 
      Consists of DIFI header, IVFC descriptor,
-     DPFS descriptor and partition hash.
+     DPFS descriptor and partition hash. Raises DifiError if it is malformed,
+     or struct.error if it is truncated.
     """
 
     def __init__(self, raw):
@@ -19,24 +31,20 @@ class PartDiscriptor(object):
             = struct.unpack('<IIQQQQQQBB2xQ', raw[0:0x44])
 
         if DIFI != 0x49464944:
-            print("Error: Wrong DIFI magic")
-            exit(1)
+            raise DifiError("Wrong DIFI magic")
 
         if ver != 0x00010000:
-            print("Error: Wrong DIFI version")
-            exit(1)
+            raise DifiError("Wrong DIFI version")
 
         if externalIVFCL4 == 0:
             self.externalIVFCL4 = False
         elif externalIVFCL4 == 1:
             self.externalIVFCL4 = True
         else:
-            print("Error: Wrong externalIVFCL4 value %d" % externalIVFCL4)
-            exit(1)
+            raise DifiError("Wrong externalIVFCL4 value %d" % externalIVFCL4)
 
         if self.DPFSL1Selector > 1:
-            print("Error: Wrong DPFSL1Selector value %d" % self.DPFSL1Selector)
-            exit(1)
+            raise DifiError("Wrong DPFSL1Selector value %d" % self.DPFSL1Selector)
 
         # Reads IVFC descriptor
         IVFC, ver, masterHashSize, \
@@ -48,16 +56,13 @@ class PartDiscriptor(object):
                 '<IIQQQI4xQQI4xQQI4xQQI4xQ', raw[IVFCOff: (IVFCOff + IVFCSize)])
 
         if IVFC != 0x43465649:
-            print("Error: Wrong IVFC magic")
-            exit(1)
+            raise DifiError("Wrong IVFC magic")
 
         if ver != 0x00020000:
-            print("Error: Wrong IVFC version")
-            exit(1)
+            raise DifiError("Wrong IVFC version")
 
         if masterHashSize != hashSize:
-            print("Error: Master hash size mismatch")
-            exit(1)
+            raise DifiError("Master hash size mismatch")
 
         if unknown != 0x78:
             print("Warning: unknown = 0x%X" % unknown)
@@ -75,12 +80,10 @@ class PartDiscriptor(object):
             = struct.unpack('<IIQQI4xQQI4xQQI4x', raw[DPFSOff: (DPFSOff + DPFSSize)])
 
         if DPFS != 0x53465044:
-            print("Error: Wrong DPFS magic")
-            exit(1)
+            raise DifiError("Wrong DPFS magic")
 
         if ver != 0x00010000:
-            print("Error: Wrong DPFS version")
-            exit(1)
+            raise DifiError("Wrong DPFS version")
 
         self.DPFSL1BlockSize = 2 ** DPFSL1BlockSize
         self.DPFSL2BlockSize = 2 ** DPFSL2BlockSize
@@ -92,93 +95,481 @@ class PartDiscriptor(object):
 
 def getDPFSLevel(part, off, size):
     """ Gets the data pair of a DPFS level """
-    return (part[off: off + size], part[off + size: off + 2 * size])
+    return (sliceImage(part, off, size), sliceImage(part, off + size, size))
+
+
+class ImageView(object):
+    """ Base of read-only virtual images
+
+     Slicing copies out the bytes of the range, while view() gets a sub-range
+     without reading anything. Subclasses implement read().
+    """
+
+    def __init__(self, size):
+        self.offset = 0
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            if step != 1:
+                raise ValueError("%s does not support extended slicing" %
+                                 type(self).__name__)
+            return self.read(start, max(0, stop - start))
+        if key < 0:
+            key += self.size
+        if key < 0 or key >= self.size:
+            raise IndexError("%s index out of range" % type(self).__name__)
+        return self.read(key, 1)[0]
+
+    def view(self, offset, size):
+        """ Gets a sub-view without copying any data
+
+         Like slicing a buffer, the range is clamped to the view.
+        """
+        offset = min(max(offset, 0), self.size)
+        sub = copy.copy(self)
+        sub.offset = self.offset + offset
+        sub.size = min(max(size, 0), self.size - offset)
+        return sub
+
+
+def sliceImage(image, off, size):
+    """ Gets a range of an image without reading it """
+    if isinstance(image, ImageView):
+        return image.view(off, size)
+    return image[off: off + size]
+
+
+def getDPFSRuns(selector, blockCount):
+    """ Expands a DPFS selector into runs of blocks taking the same data
+
+     Returns a list of (first block, selector bit) for each run. A run ends
+     where the next one starts.
+    """
+    wordCount = (blockCount + 31) // 32
+    if len(selector) < wordCount * 4:
+        raise DifiError("DPFS selector too short")
+
+    # Re-packs the u32 array in big endian so that the bits read MSB first
+    words = struct.unpack('<%dI' % wordCount, selector[0: wordCount * 4])
+    bits = int.from_bytes(struct.pack('>%dI' % wordCount, *words), 'big')
+    bits = format(bits, '0%db' % (wordCount * 32))[:blockCount]
+    return [(run.start(), int(run.group()[0]))
+            for run in re.finditer('0+|1+', bits)]
+
+
+class DPFSView(ImageView):
+    """ Read-only view of the active data of a DPFS level
+
+     Each offset is mapped through the selector bits of the previous level
+     to the active one of the data pair. Consecutive blocks taking the same
+     side are merged into runs up front, so a read is one slice per run.
+     Bytes are only copied when read. If one side of the pair is short, as
+     in a truncated file, the view is as long as the shorter side.
+    """
+
+    def __init__(self, selector, data, dataBlockSize):
+        super().__init__(min(len(data[0]), len(data[1])))
+        self.data = data
+        blockCount = (self.size + dataBlockSize - 1) // dataBlockSize
+        runs = getDPFSRuns(selector, blockCount)
+        self.runStarts = [block * dataBlockSize for block, _ in runs]
+        self.runBits = [bit for _, bit in runs]
+
+    def read(self, offset, size):
+        """ Copies out the active data in [offset, offset + size)
+
+         Like slicing, the read stops at the end of the view.
+        """
+        pos = self.offset + max(offset, 0)
+        end = min(pos + size, self.offset + self.size)
+        if pos >= end or not self.runStarts:
+            return b''
+        pieces = []
+        run = bisect.bisect_right(self.runStarts, pos) - 1
+        while pos < end:
+            if run + 1 < len(self.runStarts):
+                runEnd = min(self.runStarts[run + 1], end)
+            else:
+                runEnd = end
+            pieces.append(self.data[self.runBits[run]][pos: runEnd])
+            pos = runEnd
+            run += 1
+        return b''.join(pieces)
 
 
 def applyDPFSLevel(selector, data, dataBlockSize):
-    """ Reconstructs active data of a DPFS level using the previous level """
-    dataPos = 0
-    selectorPos = 0
-    output = bytearray()
-    dataLen = len(data[0])
-    while True:
-        u32, = struct.unpack('<I', selector[selectorPos: selectorPos + 4])
-        for i in range(32):
-            bit = (u32 >> (31 - i)) & 1
-            tranSize = min(dataLen, dataBlockSize)
-            output.extend(data[bit][dataPos: dataPos + tranSize])
-            dataPos += tranSize
-            dataLen -= tranSize
-            if dataLen <= 0:
-                return output
+    """ Gets a view of active data of a DPFS level using the previous level """
+    return DPFSView(selector, data, dataBlockSize)
+
 
-        selectorPos += 4
+def checkPartitionSize(part, discriptor):
+    """ Raises DifiError if the levels of a partition do not fit in it
+
+     A partition cut short, as in a truncated file, would otherwise only
+     show up as unhashed blocks or short tables further on.
+    """
+    levels = [("DPFS level 1", discriptor.DPFSL1Off, discriptor.DPFSL1Size * 2),
+              ("DPFS level 2", discriptor.DPFSL2Off, discriptor.DPFSL2Size * 2),
+              ("DPFS level 3", discriptor.DPFSL3Off, discriptor.DPFSL3Size * 2)]
+    if discriptor.externalIVFCL4:
+        levels.append(("IVFC level 4", discriptor.IVFCL4OffExt,
+                       discriptor.IVFCL4Size))
+    for name, offset, size in levels:
+        if offset + size > len(part):
+            raise DifiError("Partition too short: %s ends at 0x%X, past 0x%X"
+                            % (name, offset + size, len(part)))
 
 
 def unwrapDPFS(part, discriptor):
-    """ Reconstructs active data of the most inner DPFS level """
+    """ Gets a view of the active data of the most inner DPFS level
+
+     The level 2 selector is small and is read once to build the level 3
+     runs, while level 3 stays a virtual view over the partition.
+    """
     l1 = getDPFSLevel(part, discriptor.DPFSL1Off, discriptor.DPFSL1Size)
     l2 = getDPFSLevel(part, discriptor.DPFSL2Off, discriptor.DPFSL2Size)
     l3 = getDPFSLevel(part, discriptor.DPFSL3Off, discriptor.DPFSL3Size)
     l1active = l1[discriptor.DPFSL1Selector]
     l2active = applyDPFSLevel(l1active, l2, discriptor.DPFSL2BlockSize)
-    l3active = applyDPFSLevel(l2active, l3, discriptor.DPFSL3BlockSize)
+    l3active = applyDPFSLevel(l2active[:], l3, discriptor.DPFSL3BlockSize)
     return l3active
 
 
 def getIVFCLevel(part, off, size):
     """ Gets the data of a IVFC level """
-    return part[off: off + size]
+    return sliceImage(part, off, size)
+
+
+def verifyIVFCBlocks(hash, data, dataBlockSize, first, last):
+    """ Verifies blocks [first, last) of a IVFC level
+
+     Returns the data of each block, or None for blocks that are not hashed.
+    """
+    output = []
+    for i in range(first, last):
+        hashChunk = hash[i * 0x20: (i + 1) * 0x20]
+        dataChunk = data[i * dataBlockSize: (i + 1) * dataBlockSize]
+        dataHash = hashlib.sha256(dataChunk)
+        if len(dataChunk) < dataBlockSize:
+            dataHash.update(b'\x00' * (dataBlockSize - len(dataChunk)))
+        if dataHash.digest() == hashChunk:
+            output.append(dataChunk)
+        else:
+            output.append(None)
+    return output
+
+
+def applyIVFCLevel(hash, data, dataBlockSize, executor=None, poisoned=None):
+    """ Poisons unhashed data of a IVFC level using the hash from the previous level
 
+     If an executor is given, blocks are hashed on it in batches of 64. The
+     output keeps the block order either way. If a poisoned list is given,
+     the indices of unhashed blocks are appended to it.
+    """
+    blockCount = min((len(hash) + 0x1F) // 0x20,
+                     (len(data) + dataBlockSize - 1) // dataBlockSize)
+
+    if executor is None:
+        chunks = verifyIVFCBlocks(hash, data, dataBlockSize, 0, blockCount)
+    else:
+        batchSize = 64
+        batches = executor.map(
+            lambda first: verifyIVFCBlocks(hash, data, dataBlockSize, first,
+                                           min(first + batchSize, blockCount)),
+            range(0, blockCount, batchSize))
+        chunks = [chunk for batch in batches for chunk in batch]
 
-def applyIVFCLevel(hash, data, dataBlockSize):
-    """ Poisons unhashed data of a IVFC level using the hash from the previous level """
-    hashPos = 0
-    dataPos = 0
     output = bytearray()
-    dataLen = len(data)
-    while (hashPos < len(hash)):
-        hashChunk = hash[hashPos: hashPos + 0x20]
-        tranSize = min(dataLen, dataBlockSize)
-        dataChunk = data[dataPos: dataPos + tranSize]
-        dataChunkAlign = dataChunk + b'\x00' * (dataBlockSize - tranSize)
-        if hashlib.sha256(dataChunkAlign).digest() == hashChunk:
+    for i, dataChunk in enumerate(chunks):
+        if dataChunk is not None:
             output.extend(dataChunk)
         else:
             # fill unhashed data with 0xDD
-            output.extend(b'\xDD' * len(dataChunk))
-        hashPos += 0x20
-        dataPos += dataBlockSize
-        dataLen -= tranSize
-        if dataLen <= 0:
+            output.extend(
+                b'\xDD' * min(dataBlockSize, len(data) - i * dataBlockSize))
+            if poisoned is not None:
+                poisoned.append(i)
+    return output
+
+
+def getIVFCChunk(hash, data, dataBlockSize, first, last):
+    """ Verifies blocks [first, last) of a IVFC level and gets their output
+
+     Returns the data of the blocks with unhashed ones filled with 0xDD like
+     in applyIVFCLevel, and the indices of the unhashed blocks. Recorded
+     as the difi.verifyStream stage, apart from the writing of the output.
+    """
+    with extract_stats.stage("difi.verifyStream") as record:
+        output = bytearray()
+        poisoned = []
+        blocks = verifyIVFCBlocks(hash, data, dataBlockSize, first, last)
+        for i, dataChunk in enumerate(blocks, first):
+            if dataChunk is not None:
+                output.extend(dataChunk)
+            else:
+                output.extend(b'\xDD' *
+                              min(dataBlockSize, len(data) - i * dataBlockSize))
+                poisoned.append(i)
+        record.bytes = len(output)
+    return output, poisoned
+
+
+def streamIVFCLevel(hash, data, dataBlockSize, executor, window, poisoned,
+                    chunkSize=0x100000):
+    """ Yields the output of applyIVFCLevel in order, chunkSize at a time
+
+     Chunks are verified on the executor, up to window chunks ahead of the
+     one being consumed, so the consumer can write a chunk while the next
+     ones are read and hashed. The indices of unhashed blocks are appended
+     to poisoned.
+    """
+    blockCount = min((len(hash) + 0x1F) // 0x20,
+                     (len(data) + dataBlockSize - 1) // dataBlockSize)
+    chunkBlocks = max(1, chunkSize // dataBlockSize)
+    firsts = iter(range(0, blockCount, chunkBlocks))
+    pending = collections.deque()
+
+    def submit(first):
+        pending.append(executor.submit(
+            getIVFCChunk, hash, data, dataBlockSize, first,
+            min(first + chunkBlocks, blockCount)))
+
+    for first in firsts:
+        submit(first)
+        if len(pending) == window:
             break
+    while pending:
+        future = pending.popleft()
+        first = next(firsts, None)
+        if first is not None:
+            submit(first)
+        output, chunkPoisoned = future.result()
+        poisoned.extend(chunkPoisoned)
+        yield output
+
+
+def streamRestoredLevel(data, dataBlockSize, size, poisoned,
+                        chunkSize=0x100000):
+    """ Yields the output of restoreIVFCLevel in order, chunkSize at a time """
+    chunkSize = max(dataBlockSize, chunkSize // dataBlockSize * dataBlockSize)
+    poisoned = sorted(poisoned)
+    p = 0
+    for pos in range(0, size, chunkSize):
+        end = min(pos + chunkSize, size)
+        output = bytearray(data[pos: end])
+        while p < len(poisoned) and poisoned[p] * dataBlockSize < end:
+            start = poisoned[p] * dataBlockSize - pos
+            output[start: start + dataBlockSize] = \
+                b'\xDD' * len(output[start: start + dataBlockSize])
+            p += 1
+        yield output
+
+
+def restoreIVFCLevel(data, dataBlockSize, size, poisoned):
+    """ Rebuilds the output of applyIVFCLevel from a known poisoned block list """
+    if not poisoned:
+        return data[0: size]
+    output = bytearray(data[0: size])
+    for i in poisoned:
+        start = i * dataBlockSize
+        end = min(start + dataBlockSize, size)
+        output[start: end] = b'\xDD' * (end - start)
     return output
 
 
-def unwrapIVFC(partActive, discriptor, l4):
-    """ Poisons IVFC tree to the most inner level """
+class IVFCView(ImageView):
+    """ Read-only view of a IVFC level that verifies blocks on first read
+
+     The hash of a block is read from the previous level, which can be
+     another IVFCView, so reading a block also verifies the parent blocks it
+     depends on. The result is memoized per block. Unhashed data reads as
+     0xDD like in applyIVFCLevel.
+    """
+
+    def __init__(self, hash, data, dataBlockSize):
+        blockCount = min((len(hash) + 0x1F) // 0x20,
+                         (len(data) + dataBlockSize - 1) // dataBlockSize)
+        super().__init__(min(len(data), blockCount * dataBlockSize))
+        self.hash = hash
+        self.data = data
+        self.dataBlockSize = dataBlockSize
+        # 0 = not verified yet, 1 = hashed, 2 = unhashed
+        self.verified = bytearray(blockCount)
+
+    def isHashed(self, block):
+        if self.verified[block] == 0:
+            dataChunk, = verifyIVFCBlocks(self.hash, self.data,
+                                          self.dataBlockSize, block, block + 1)
+            self.verified[block] = 1 if dataChunk is not None else 2
+        return self.verified[block] == 1
+
+    def read(self, offset, size):
+        """ Copies out the verified data in [offset, offset + size) """
+        pos = self.offset + offset
+        end = pos + size
+        pieces = []
+        while pos < end:
+            block = pos // self.dataBlockSize
+            blockEnd = min((block + 1) * self.dataBlockSize, end)
+            if self.isHashed(block):
+                pieces.append(self.data[pos: blockEnd])
+            else:
+                # fill unhashed data with 0xDD
+                pieces.append(b'\xDD' * (blockEnd - pos))
+            pos = blockEnd
+        return b''.join(pieces)
+
+
+def getIVFCLevels(partActive, discriptor, l4):
+    """ Gets the data of the four IVFC levels. l4 is given if it is external """
     l1 = getIVFCLevel(partActive, discriptor.IVFCL1Off, discriptor.IVFCL1Size)
     l2 = getIVFCLevel(partActive, discriptor.IVFCL2Off, discriptor.IVFCL2Size)
     l3 = getIVFCLevel(partActive, discriptor.IVFCL3Off, discriptor.IVFCL3Size)
     if l4 is None:
         l4 = getIVFCLevel(partActive, discriptor.IVFCL4Off,
                           discriptor.IVFCL4Size)
+    return l1, l2, l3, l4
 
-    l1p = applyIVFCLevel(discriptor.hash, l1, discriptor.IVFCL1BlockSize)
-    l2p = applyIVFCLevel(l1p, l2, discriptor.IVFCL2BlockSize)
-    l3p = applyIVFCLevel(l2p, l3, discriptor.IVFCL3BlockSize)
-    l4p = applyIVFCLevel(l3p, l4, discriptor.IVFCL4BlockSize)
 
-    return l4p
+def unwrapIVFC(partActive, discriptor, l4, threadCount=1, lazy=False,
+               cache=None):
+    """ Poisons IVFC tree to the most inner level
 
+     Each level is verified with up to threadCount threads. Levels are still
+     processed in order, as each one is verified by the previous one.
 
-def unwrap(discriptorRaw, partitionRaw):
-    """ Unwraps DPFS and IVFC tree of a partition according to the partiton discriptor """
-    discriptor = PartDiscriptor(discriptorRaw)
-    active = unwrapDPFS(partitionRaw, discriptor)
-    if discriptor.externalIVFCL4:
-        IVFCL4 = partitionRaw[discriptor.IVFCL4OffExt:
-                              discriptor.IVFCL4OffExt + discriptor.IVFCL4Size]
+     If lazy is set, nothing is hashed up front. An IVFCView of level 4 is
+     returned instead, which verifies blocks as they are read.
+
+     If an IVFCCache is given, a partition that has been verified before is
+     not hashed again. The cache is not used in lazy mode.
+    """
+    l1, l2, l3, l4 = getIVFCLevels(partActive, discriptor, l4)
+
+    if lazy:
+        l1p = IVFCView(discriptor.hash, l1, discriptor.IVFCL1BlockSize)
+        l2p = IVFCView(l1p, l2, discriptor.IVFCL2BlockSize)
+        l3p = IVFCView(l2p, l3, discriptor.IVFCL3BlockSize)
+        return IVFCView(l3p, l4, discriptor.IVFCL4BlockSize)
+
+    if cache is not None:
+        cacheKey = cache.getKey(discriptor.hash, (l1, l2, l3, l4))
+        cached = cache.lookup(cacheKey)
+        if cached is not None:
+            size, poisoned = cached
+            return restoreIVFCLevel(l4, discriptor.IVFCL4BlockSize,
+                                    size, poisoned)
+
+    if threadCount > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(threadCount)
     else:
-        IVFCL4 = None
-    return (unwrapIVFC(active, discriptor, IVFCL4), discriptor.externalIVFCL4)
+        executor = None
+
+    try:
+        l1p = applyIVFCLevel(discriptor.hash, l1,
+                             discriptor.IVFCL1BlockSize, executor)
+        l2p = applyIVFCLevel(l1p, l2, discriptor.IVFCL2BlockSize, executor)
+        l3p = applyIVFCLevel(l2p, l3, discriptor.IVFCL3BlockSize, executor)
+        poisoned = []
+        l4p = applyIVFCLevel(l3p, l4, discriptor.IVFCL4BlockSize, executor,
+                             poisoned)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if cache is not None:
+        cache.store(cacheKey, len(l4p), poisoned)
+
+    return l4p
+
+
+def unwrap(discriptorRaw, partitionRaw, threadCount=1, lazy=False,
+           cache=None):
+    """ Unwraps DPFS and IVFC tree of a partition according to the partiton discriptor
+
+     partitionRaw can be any buffer, such as a memoryview over a mapped file,
+     or an ImageView. It is only sliced, never copied as a whole. The inner image is returned
+     as a memoryview so that callers can slice it without copying either.
+
+     If lazy is set, the inner image is an IVFCView that verifies blocks on
+     first read. Use sliceImage() to get sub-ranges of it without reading.
+    """
+    with extract_stats.stage("difi.unwrap", len(partitionRaw)):
+        discriptor = PartDiscriptor(discriptorRaw)
+        checkPartitionSize(partitionRaw, discriptor)
+        with extract_stats.stage("difi.unwrapDPFS"):
+            active = unwrapDPFS(partitionRaw, discriptor)
+        if discriptor.externalIVFCL4:
+            IVFCL4 = sliceImage(partitionRaw, discriptor.IVFCL4OffExt,
+                                discriptor.IVFCL4Size)
+        else:
+            IVFCL4 = None
+        with extract_stats.stage("difi.unwrapIVFC") as record:
+            inner = unwrapIVFC(active, discriptor, IVFCL4, threadCount, lazy,
+                               cache)
+            record.bytes = len(inner)
+        if not lazy:
+            inner = memoryview(inner)
+    return (inner, discriptor.externalIVFCL4)
+
+
+def unwrapStream(discriptorRaw, partitionRaw, threadCount=1, cache=None):
+    """ Unwraps a partition like unwrap, but gets the inner image in chunks
+
+     Only IVFC levels 1 to 3, which are hashes, are verified up front, as
+     part of the difi.unwrapStream stage. Level 4 is verified while the
+     returned iterator is consumed, which keeps threadCount + 1 chunks of
+     1 MiB in flight on a thread pool, so memory use does not grow with the
+     partition and the first chunk is ready early. Each chunk is recorded
+     as a difi.verifyStream stage. The IVFCCache, if given, is updated once the iterator is
+     exhausted. Returns (chunk iterator, inner size, externalIVFCL4).
+    """
+    with extract_stats.stage("difi.unwrapStream", len(partitionRaw)):
+        discriptor = PartDiscriptor(discriptorRaw)
+        checkPartitionSize(partitionRaw, discriptor)
+        with extract_stats.stage("difi.unwrapDPFS"):
+            active = unwrapDPFS(partitionRaw, discriptor)
+        if discriptor.externalIVFCL4:
+            IVFCL4 = sliceImage(partitionRaw, discriptor.IVFCL4OffExt,
+                                discriptor.IVFCL4Size)
+        else:
+            IVFCL4 = None
+        l1, l2, l3, l4 = getIVFCLevels(active, discriptor, IVFCL4)
+        l4BlockSize = discriptor.IVFCL4BlockSize
+
+        cacheKey = None
+        if cache is not None:
+            cacheKey = cache.getKey(discriptor.hash, (l1, l2, l3, l4))
+            cached = cache.lookup(cacheKey)
+            if cached is not None:
+                size, poisoned = cached
+                return (streamRestoredLevel(l4, l4BlockSize, size, poisoned),
+                        size, discriptor.externalIVFCL4)
+
+        with extract_stats.stage("difi.unwrapIVFC") as record:
+            l1p = applyIVFCLevel(discriptor.hash, l1,
+                                 discriptor.IVFCL1BlockSize)
+            l2p = applyIVFCLevel(l1p, l2, discriptor.IVFCL2BlockSize)
+            l3p = applyIVFCLevel(l2p, l3, discriptor.IVFCL3BlockSize)
+            record.bytes = len(l1) + len(l2) + len(l3)
+    blockCount = min((len(l3p) + 0x1F) // 0x20,
+                     (len(l4) + l4BlockSize - 1) // l4BlockSize)
+    size = min(len(l4), blockCount * l4BlockSize)
+
+    def generate():
+        executor = concurrent.futures.ThreadPoolExecutor(max(1, threadCount))
+        poisoned = []
+        try:
+            yield from streamIVFCLevel(l3p, l4, l4BlockSize, executor,
+                                       max(1, threadCount) + 1, poisoned)
+        finally:
+            executor.shutdown(cancel_futures=True)
+        if cacheKey is not None:
+            cache.store(cacheKey, size, poisoned)
+
+    return (generate(), size, discriptor.externalIVFCL4)
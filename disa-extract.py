@@ -1,14 +1,14 @@
 #!/usr/bin/env python3
 
-import os
 import os.path
-import struct
 import sys
-import hashlib
 
-import difi
-import savefilesystem
+import blob_store
+import extract_manifest
+import extract_stats
+import ivfc_cache
 import key_engine
+import save_archive
 
 try:
     from secrets import Secrets
@@ -18,34 +18,6 @@ except Exception as e:
         pass
 
 
-def getDigestBlock(saveType, saveId, header):
-    if saveType == "nand":
-        return b"CTR-SYS0" + struct.pack("<Q", saveId) + header
-    sav0Block = hashlib.sha256(b"CTR-SAV0" + header).digest()
-    return b"CTR-SIGN" + struct.pack("<Q", saveId) + sav0Block
-
-
-def cryptoUnwrap(disa, saveType, saveId, key):
-    if saveType != "sd":
-        print("Error: only SD save supports decryption.")
-        return None
-
-    if saveId is None:
-        print("Error: ID needed to decrypt the save.")
-        return None
-
-    if key is None:
-        print("No enough secrets provided to decrypt.")
-        return None
-
-    high = saveId >> 32
-    low = saveId & 0xFFFFFFFF
-    path = "/title/%08x/%08x/data/00000001.sav" % (high, low)
-
-    import sd_decrypt
-    return sd_decrypt.DecryptSdFile(disa, path, key)
-
-
 def main():
     if len(sys.argv) < 2:
         print("Usage: %s input [output] [OPTIONS]" % sys.argv[0])
@@ -61,6 +33,19 @@ def main():
         print("  -id ID           The save ID of the file in hex")
         print("Decryption for SD save is also supported by the following option")
         print("  -decrypt         Decrypt SD save. Requires -sd and -id arguments")
+        print("Other options")
+        print("  -threads N       Number of threads for decryption and IVFC hash")
+        print("                   verification (default 1)")
+        print("  -lazy            Only verify IVFC blocks that are actually read")
+        print("  -cache DIR       Remember IVFC verification results in DIR and skip")
+        print("                   hashing partitions that have been verified before")
+        print("  -incremental     Keep a manifest in the output directory, skip the save")
+        print("                   if it is unchanged and only rewrite changed files")
+        print("  -store DIR       Store each distinct output file once in DIR, named after")
+        print("                   its SHA-256, and extract hardlinks to it")
+        print("  -stats FILE      Write the time, CPU time, bytes and peak memory of each")
+        print("                   stage to FILE as JSON (tracing memory slows the run down)")
+        print("  -profile FILE    Profile the run with cProfile and dump the result to FILE")
 
         exit(1)
 
@@ -69,6 +54,11 @@ def main():
     saveId = None
     saveType = None
     decrypt = False
+    threadCount = 1
+    lazy = False
+    cache = None
+    incremental = False
+    store = None
 
     i = 1
     while i < len(sys.argv):
@@ -83,6 +73,25 @@ def main():
             saveType = "card"
         elif sys.argv[i] == "-decrypt":
             decrypt = True
+        elif sys.argv[i] == "-threads":
+            i += 1
+            threadCount = int(sys.argv[i])
+        elif sys.argv[i] == "-lazy":
+            lazy = True
+        elif sys.argv[i] == "-cache":
+            i += 1
+            cache = ivfc_cache.IVFCCache(sys.argv[i])
+        elif sys.argv[i] == "-incremental":
+            incremental = True
+        elif sys.argv[i] == "-store":
+            i += 1
+            store = blob_store.BlobStore(sys.argv[i])
+        elif sys.argv[i] == "-stats":
+            i += 1
+            extract_stats.enable(sys.argv[i])
+        elif sys.argv[i] == "-profile":
+            i += 1
+            extract_stats.enableProfile(sys.argv[i])
         else:
             if inputPath is None:
                 inputPath = sys.argv[i]
@@ -94,193 +103,42 @@ def main():
         print("Error: no input file given.")
         exit(1)
 
-    disa = open(inputPath, 'rb')
-
-    secretsDb = Secrets()
-    keyEngine = key_engine.KeyEngine(secretsDb)
-
-    if decrypt:
-        disa = cryptoUnwrap(disa, saveType, saveId,
-                            keyEngine.getKeySdDecrypt())
-        if disa is None:
-            exit(1)
-
-    Cmac = disa.read(0x10)
-    disa.seek(0x100, os.SEEK_SET)
-    header = disa.read(0x100)
-
     if outputPath is None:
         print("No output directory given. Will only do data checking.")
 
-    if saveType is None:
-        print("No save type specified. Will skip CMAC verification.")
-    elif saveType == "nand" or saveType == "sd":
-        if saveId is None:
-            print("No save ID specified. Will skip CMAC verification.")
-        else:
-            key = keyEngine.getKeySdNandCmac()
-            if key is None:
-                print("No enough secrets provided. Will skip CMAC verification.")
-            else:
-                digest = hashlib.sha256(getDigestBlock(
-                    saveType, saveId, header)).digest()
-                import cmac
-                if Cmac != cmac.AesCmac(digest, key):
-                    print("Error: CMAC mismatch.")
-                    exit(1)
-                else:
-                    print("Info: CMAC verified.")
-    else:
-        print("Unsupported save type. Will skip CMAC verification.")
-
-    # Reads DISA header
-    disa.seek(0x100, os.SEEK_SET)
-    DISA, ver, \
-        partCount, secPartTableOff, priPartTableOff, partTableSize, \
-        partADiscriptorOff, partADiscriptorSize, \
-        partBDiscriptorOff, partBDiscriptorSize, \
-        partAOff, partASize, partBOff, partBSize, \
-        activeTable, tableHash = struct.unpack(
-            '<III4xQQQQQQQQQQQB3x32s116x', header)
-
-    if DISA != 0x41534944:
-        print("Error: Not a DISA format")
-        exit(1)
-
-    if ver != 0x00040000:
-        print("Error: Wrong DISA version")
-        exit(1)
-
-    if partCount == 1:
-        hasData = False
-        print("Info: No partition B")
-    elif partCount == 2:
-        hasData = True
-        print("Info: Has partition B")
-    else:
-        print("Error: Wrong partition count %d" % partCount)
-        exit(1)
-
-    if activeTable == 0:
-        partTableOff = priPartTableOff
-    elif activeTable == 1:
-        partTableOff = secPartTableOff
-    else:
-        print("Error: Wrong active table ID %d" % activeTable)
-        exit(1)
-
-    # Verify partition table hash
-    disa.seek(partTableOff, os.SEEK_SET)
-    partTable = disa.read(partTableSize)
-
-    if hashlib.sha256(partTable).digest() != tableHash:
-        print("Error: Partition table hash mismatch!")
+    manifest = None
+    if incremental and outputPath is not None:
+        manifest = extract_manifest.ExtractManifest(
+            os.path.join(outputPath, ".extract-manifest.json"), outputPath)
+        container = {"header": extract_manifest.getHeaderDigest(inputPath)}
+        if manifest.isContainerUnchanged(container):
+            print("Info: save unchanged since the last extraction. Skipped.")
+            print("Finished!")
+            return
+
+    keySession = key_engine.KeySession(Secrets())
+
+    try:
+        archive = save_archive.openDisa(inputPath, saveType, saveId, decrypt,
+                                        keySession, threadCount, lazy, cache)
+    except save_archive.ArchiveError as e:
+        print("Error: %s" % e)
         exit(1)
 
-    # Reads and unwraps SAVE image
-    partADescriptor = partTable[partADiscriptorOff:
-                                partADiscriptorOff + partADiscriptorSize]
-    disa.seek(partAOff, os.SEEK_SET)
-    partA = disa.read(partASize)
-    partAInner, externalIVFCL4 = difi.unwrap(partADescriptor, partA)
-    if externalIVFCL4:
-        print("Warning: partition A has an external IVFC level 4")
-
-    # Reads and unwraps DATA image
-    if hasData:
-        partBDescriptor = partTable[partBDiscriptorOff:
-                                    partBDiscriptorOff + partBDiscriptorSize]
-        disa.seek(partBOff, os.SEEK_SET)
-        partB = disa.read(partBSize)
-        dataRegion, externalIVFCL4 = difi.unwrap(partBDescriptor, partB)
-        if not externalIVFCL4:
-            print("Warning: partition B does not have an external IVFC level 4")
-
-    disa.close()
-
-    # Reads SAVE header
-    SAVE, ver, filesystemHeaderOff, imageSize, imageBlockSize, x00 \
-        = struct.unpack('<IIQQII', partAInner[0:0x20])
-
-    if SAVE != 0x45564153:
-        print("Error: Wrong SAVE magic")
-        exit(1)
-
-    if ver != 0x00040000:
-        print("Error: Wrong SAVE version")
-        exit(1)
-
-    if x00 != 0:
-        print("Warning: unknown 0 = 0x%X in SAVE header" % x00)
-
-    fsHeader = savefilesystem.Header(
-        partAInner[filesystemHeaderOff:filesystemHeaderOff + 0x68], hasData)
+    archive.printDirList()
+    archive.printFileList()
+    archive.verify()
 
-    if not hasData:
-        dataRegion = partAInner[
-            fsHeader.dataRegionOff: fsHeader.dataRegionOff +
-            fsHeader.dataRegionSize * fsHeader.blockSize]
-
-    # Parses hash tables
-    dirHashTable = savefilesystem.getHashTable(fsHeader.dirHashTableOff,
-                                               fsHeader.dirHashTableSize,
-                                               partAInner)
-
-    fileHashTable = savefilesystem.getHashTable(fsHeader.fileHashTableOff,
-                                                fsHeader.fileHashTableSize,
-                                                partAInner)
-
-    # Parses FAT
-    fat = savefilesystem.FAT(fsHeader, partAInner)
-
-    # Parses directory & file entry table
-    dirList = savefilesystem.getDirList(
-        fsHeader, partAInner, dataRegion, fat)
-
-    print("Directory list:")
-    for i in range(len(dirList)):
-        dirList[i].printEntry(i)
-
-    fileList = savefilesystem.getFileList(
-        fsHeader, partAInner, dataRegion, fat)
-
-    print("File list:")
-    for i in range(len(fileList)):
-        fileList[i].printEntryAsSave(i)
-
-    # Verifies directory & file hash table
-    print("Verifying directory hash table")
-    savefilesystem.verifyHashTable(dirHashTable, dirList)
-    print("Verifying file hash table")
-    savefilesystem.verifyHashTable(fileHashTable, fileList)
-
-    # Walks through free blocks
-    print("Walking through free blocks")
-    fat.visitFreeBlock()
-
-    def saveFileDumper(fileEntry, file, _):
-        fileSize = fileEntry.size
-
-        def blockDumper(index):
-            nonlocal fileSize
-            if fileSize == 0:
-                print("Warning: excessive block")
-                return
-            tranSize = min(fileSize, fsHeader.blockSize)
-            pos = index * fsHeader.blockSize
-            if file is not None:
-                file.write(dataRegion[pos: pos + tranSize])
-            fileSize -= tranSize
+    print("Walking through files and dumping")
+    archive.extractAll(outputPath, manifest=manifest, store=store)
 
-        if fileSize != 0:
-            fat.walk(fileEntry.blockIndex, blockDumper)
-        if fileSize != 0:
-            print("Warning: not enough block")
+    archive.fat.allVisited()
 
-    print("Walking through files and dumping")
-    savefilesystem.extractAll(dirList, fileList, outputPath, saveFileDumper)
+    # Closed only now, as in lazy mode the input is still read while dumping
+    archive.close()
 
-    fat.allVisited()
+    if manifest is not None:
+        manifest.save(container)
 
     print("Finished!")
 
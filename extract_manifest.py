@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+
+
+def getHeaderDigest(filePath):
+    """ Digests the CMAC and header of a DISA or DIFF file as stored on disk
+
+     The header holds the hash of the partition table, which covers the IVFC
+     master hash and through it all content. So the digest changes whenever
+     the content does, and it works the same for encrypted files.
+    """
+    with open(filePath, 'rb') as file:
+        return hashlib.sha256(file.read(0x200)).hexdigest()
+
+
+def getExtdataDigest(extdataDir):
+    """ Digests the header of every subfile in an extdata directory """
+    digest = hashlib.sha256()
+    for dirPath, dirNames, fileNames in os.walk(extdataDir):
+        dirNames.sort()
+        for name in sorted(fileNames):
+            filePath = os.path.join(dirPath, name)
+            digest.update(os.path.relpath(filePath, extdataDir).encode())
+            digest.update(bytes.fromhex(getHeaderDigest(filePath)))
+    return digest.hexdigest()
+
+
+class ExtractManifest(object):
+    """ Record of the previous extraction into an output directory
+
+     It stores the header digest of the input container and, for every
+     extracted file, a record of its content (size, block ranges and content
+     digest for save files; subfile header digest for extdata files). An
+     unchanged container can be skipped, and a file is only rewritten when
+     its record differs or its output is missing.
+    """
+
+    def __init__(self, path, outputDir):
+        self.path = path
+        self.outputDir = outputDir
+        try:
+            with open(path, 'r') as file:
+                self.old = json.load(file)
+        except (OSError, ValueError):
+            self.old = {"container": None, "files": {}}
+        self.new = {"container": None, "files": {}}
+
+    def outputExists(self, path, record):
+        fullPath = os.path.join(self.outputDir, path)
+        if "size" in record:
+            return os.path.isfile(fullPath) and \
+                os.path.getsize(fullPath) == record["size"]
+        return os.path.isfile(fullPath)
+
+    def isContainerUnchanged(self, container):
+        return self.old["container"] == container and all(
+            self.outputExists(path, record)
+            for path, record in self.old["files"].items())
+
+    def isFileUnchanged(self, path, record):
+        """ Compares the content of a file to the previous extraction
+
+         The block chain is only recorded: a file that was moved to other
+         blocks with the same content does not need to be rewritten.
+        """
+        old = self.old["files"].get(path)
+        if old is None:
+            return False
+        return all(old.get(key) == value for key, value in record.items()
+                   if key != "chain") and self.outputExists(path, record)
+
+    def addFile(self, path, record):
+        self.new["files"][path] = record
+
+    def save(self, container):
+        """ Removes outputs of files that are gone and writes the manifest """
+        for path in self.old["files"]:
+            if path not in self.new["files"]:
+                try:
+                    os.remove(os.path.join(self.outputDir, path))
+                except OSError:
+                    pass
+
+        self.new["container"] = container
+        dirName = os.path.dirname(os.path.abspath(self.path))
+        fd, tempPath = tempfile.mkstemp(dir=dirName, prefix=".tmp")
+        with os.fdopen(fd, 'w') as file:
+            json.dump(self.new, file)
+        os.replace(tempPath, self.path)
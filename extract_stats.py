@@ -0,0 +1,165 @@
+import atexit
+import contextlib
+import cProfile
+import json
+import threading
+import time
+import tracemalloc
+
+
+class StageRecord(object):
+    """ What one run of a stage did. Callers add the bytes they processed """
+
+    __slots__ = ('bytes',)
+
+    def __init__(self, byteCount=0):
+        self.bytes = byteCount
+
+
+class Stats(object):
+    """ Wall time, CPU time, bytes and peak allocation per extraction stage
+
+     Stages can nest (e.g. SD decryption happens inside difi.unwrap when the
+     input is decrypted on the fly), and the times of a stage include the
+     stages inside it. CPU time is for the whole process, so it includes
+     worker threads. Peak allocation is the most memory allocated by Python
+     above what was allocated when the stage started, traced with
+     tracemalloc; it is only tracked for stages on the main thread, as the
+     tracemalloc peak is shared by all threads.
+    """
+
+    def __init__(self, traceMemory=True):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.traceMemory = traceMemory
+        if traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.startWallTime = time.perf_counter()
+        self.startCpuTime = time.process_time()
+
+    def getStack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name, byteCount=0):
+        record = StageRecord(byteCount)
+        tracePeak = self.traceMemory and \
+            threading.current_thread() is threading.main_thread()
+        stack = self.getStack()
+        if tracePeak:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # The enclosing stage keeps the peak that is about to be reset
+                stack[-1][1] = max(stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            frame = [current, current]
+        else:
+            frame = None
+        stack.append(frame)
+        startWallTime = time.perf_counter()
+        startCpuTime = time.process_time()
+        try:
+            yield record
+        finally:
+            wallTime = time.perf_counter() - startWallTime
+            cpuTime = time.process_time() - startCpuTime
+            stack.pop()
+            peakAllocation = None
+            if frame is not None:
+                frame[1] = max(frame[1], tracemalloc.get_traced_memory()[1])
+                peakAllocation = frame[1] - frame[0]
+                if stack and stack[-1] is not None:
+                    stack[-1][1] = max(stack[-1][1], frame[1])
+            self.add(name, {"count": 1, "wallTime": wallTime,
+                            "cpuTime": cpuTime, "bytes": record.bytes,
+                            "peakAllocation": peakAllocation})
+
+    def add(self, name, entry):
+        """ Adds one or more runs of a stage, as recorded by another Stats """
+        with self.lock:
+            total = self.stages.get(name)
+            if total is None:
+                self.stages[name] = dict(entry)
+                return
+            for key in ("count", "wallTime", "cpuTime", "bytes"):
+                total[key] += entry[key]
+            if entry["peakAllocation"] is not None:
+                total["peakAllocation"] = max(total["peakAllocation"] or 0,
+                                              entry["peakAllocation"])
+
+    def merge(self, stages):
+        for name, entry in stages.items():
+            self.add(name, entry)
+
+    def takeStages(self):
+        """ Gets the stages recorded so far and starts over """
+        with self.lock:
+            stages = self.stages
+            self.stages = {}
+        return stages
+
+    def toDict(self):
+        result = {"wallTime": time.perf_counter() - self.startWallTime,
+                  "cpuTime": time.process_time() - self.startCpuTime,
+                  "stages": self.stages}
+        if self.traceMemory:
+            result["peakAllocation"] = tracemalloc.get_traced_memory()[1]
+        return result
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.toDict(), file, indent=1, sort_keys=True)
+
+
+stats = None
+
+
+def enable(path=None, traceMemory=True):
+    """ Starts recording stages, and writes them to path as JSON at exit """
+    global stats
+    stats = Stats(traceMemory)
+    if path is not None:
+        atexit.register(stats.save, path)
+    return stats
+
+
+def stage(name, byteCount=0):
+    """ Records a stage if stats are enabled
+
+     Used as `with extract_stats.stage(name) as record:`; bytes processed
+     can be given up front or added to record.bytes.
+    """
+    if stats is None:
+        return contextlib.nullcontext(StageRecord(byteCount))
+    return stats.stage(name, byteCount)
+
+
+def takeStages():
+    """ Gets the stages recorded in this process, e.g. to return from a job """
+    if stats is None:
+        return None
+    return stats.takeStages()
+
+
+def mergeStages(stages):
+    """ Adds stages recorded in a worker process """
+    if stats is not None and stages is not None:
+        stats.merge(stages)
+
+
+def enableProfile(path):
+    """ Profiles the rest of the run with cProfile and dumps it to path at exit
+
+     The dump can be read with pstats or snakeviz.
+    """
+    profile = cProfile.Profile()
+
+    def save():
+        profile.disable()
+        profile.dump_stats(path)
+
+    atexit.register(save)
+    profile.enable()
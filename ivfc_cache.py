@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+
+
+class IVFCCache(object):
+    """ On-disk cache of IVFC verification results
+
+     Each entry is a small JSON file in the cache directory, named after a
+     key derived from the partition master hash and a digest of the IVFC
+     levels. It records the size of the verified level 4 and the indices of
+     its poisoned blocks. The modification time of an entry is bumped on
+     every hit, and the least recently used entries are removed once the
+     directory grows past maxSize bytes. The size is checked when the cache
+     is opened and after every 256 stores.
+    """
+
+    def __init__(self, path, maxSize=16 * 1024 * 1024):
+        self.path = path
+        self.maxSize = maxSize
+        self.storeCount = 0
+        os.makedirs(path, exist_ok=True)
+        self.evict()
+
+    def getKey(self, masterHash, levels):
+        """ Derives the cache key of a partition
+
+         All four levels are digested, not only level 4, because levels 1
+         to 3 decide which level 4 blocks are poisoned as well.
+        """
+        digest = hashlib.sha256(masterHash)
+        for level in levels:
+            digest.update(len(level).to_bytes(8, 'little'))
+            for pos in range(0, len(level), 0x100000):
+                digest.update(level[pos: pos + 0x100000])
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        """ Gets (size, poisoned block list) of a key, or None on a miss """
+        entryPath = os.path.join(self.path, key)
+        try:
+            with open(entryPath, 'r') as entry:
+                content = json.load(entry)
+            os.utime(entryPath)
+        except (OSError, ValueError):
+            return None
+        return (content["size"], content["poisoned"])
+
+    def store(self, key, size, poisoned):
+        fd, tempPath = tempfile.mkstemp(dir=self.path, prefix=".tmp")
+        with os.fdopen(fd, 'w') as entry:
+            json.dump({"size": size, "poisoned": poisoned}, entry)
+        os.replace(tempPath, os.path.join(self.path, key))
+        self.storeCount += 1
+        if self.storeCount % 256 == 0:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        totalSize = 0
+        for name in os.listdir(self.path):
+            if name.startswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue  # removed by another process
+            entries.append((stat.st_mtime, stat.st_size, name))
+            totalSize += stat.st_size
+
+        entries.sort()
+        for _, size, name in entries:
+            if totalSize <= self.maxSize:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            totalSize -= size
@@ -23,3 +23,42 @@ class KeyEngine(object):
             return scrambleKey(self.secrets.key0x34X, self.secrets.keyMovable, self.secrets.keyConst)
         except AttributeError:
             return None
+
+
+class KeySession(object):
+    """ Keys and cipher setup shared by all files of one run
+
+     The scrambled keys are derived once, and the AES-CMAC subkeys are set up
+     once and copied for each message, so extdata with hundreds of subfiles
+     does not redo this work per file.
+    """
+
+    def __init__(self, secrets):
+        keyEngine = KeyEngine(secrets)
+        self.keySdNandCmac = keyEngine.getKeySdNandCmac()
+        self.keySdDecrypt = keyEngine.getKeySdDecrypt()
+        self.cmacTemplate = None
+        self.sdDecrypt = None
+
+    def getKeySdNandCmac(self):
+        return self.keySdNandCmac
+
+    def getKeySdDecrypt(self):
+        return self.keySdDecrypt
+
+    def sdNandCmac(self, data):
+        """ Computes the AES-CMAC of data with the SD/NAND CMAC key """
+        if self.cmacTemplate is None:
+            import cmac
+            self.cmacTemplate = cmac.AesCmacInit(self.keySdNandCmac)
+        cobj = self.cmacTemplate.copy()
+        cobj.update(data)
+        return cobj.digest()
+
+    def decryptSdFile(self, file, filePath, threadCount=1):
+        """ Opens an encrypted SD file with the SD decryption key """
+        if self.sdDecrypt is None:
+            import sd_decrypt
+            self.sdDecrypt = sd_decrypt
+        return self.sdDecrypt.DecryptSdFile(file, filePath, self.keySdDecrypt,
+                                            threadCount)
@@ -0,0 +1,61 @@
+import mmap
+import os
+import threading
+
+import difi
+import extract_stats
+
+
+class FileImage(difi.ImageView):
+    """ Virtual image over a seekable file object that cannot be mapped
+
+     Slicing seeks to and reads only the requested range, so a file that is
+     decrypted on the fly is only decrypted where it is read.
+    """
+
+    def __init__(self, file):
+        super().__init__(file.seek(0, os.SEEK_END))
+        self.file = file
+        self.lock = threading.Lock()
+
+    def read(self, offset, size):
+        with self.lock:
+            self.file.seek(self.offset + offset, os.SEEK_SET)
+            return self.file.read(size)
+
+
+def mapFile(file):
+    """ Gets a read-only memoryview over the whole content of a file object
+
+     Regular files are memory-mapped, so slicing the result never copies the
+     image into the heap. In-memory files share their content directly.
+     Other seekable file objects are wrapped in a FileImage, and anything
+     else is read once as a fallback. Recorded as the "read" stage.
+    """
+    with extract_stats.stage("read") as record:
+        image = getFileImage(file)
+        record.bytes = len(image)
+    return image
+
+
+def getFileImage(file):
+    try:
+        fileno = file.fileno()
+    except (AttributeError, OSError):
+        fileno = None
+
+    if fileno is not None:
+        try:
+            return memoryview(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ))
+        except (ValueError, OSError):
+            pass  # empty file or not mappable (e.g. a pipe)
+
+    if hasattr(file, "getvalue"):
+        # Unlike getbuffer(), this does not pin the file, so it can still be
+        # closed. It does not copy a BytesIO that has not been written to.
+        return memoryview(file.getvalue())
+
+    if file.seekable():
+        return FileImage(file)
+
+    return memoryview(file.read())
@@ -0,0 +1,787 @@
+import concurrent.futures
+import functools
+import hashlib
+import os.path
+import struct
+
+import difi
+import extract_manifest
+import extract_stats
+import key_engine
+import mapped_file
+import savefilesystem
+
+
+class ArchiveError(Exception):
+    """ Raised when a file cannot be opened as an archive """
+
+
+def raisesArchiveError(function):
+    """ Makes a parsing function raise ArchiveError for malformed input
+
+     A bad partition discriptor (difi.DifiError) or a header cut short by
+     the end of the file (struct.error) would otherwise escape as other
+     exceptions.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        except difi.DifiError as e:
+            raise ArchiveError(str(e)) from e
+        except struct.error as e:
+            raise ArchiveError("truncated file (%s)" % e) from e
+    return wrapper
+
+
+def checkInFile(image, offset, size, name):
+    """ Raises ArchiveError if a region of the file is cut off by its end """
+    if offset + size > len(image):
+        raise ArchiveError(
+            "truncated file (%s ends at 0x%X, past the end of the file at 0x%X)"
+            % (name, offset + size, len(image)))
+
+
+def getSaveDigestBlock(saveType, saveId, header):
+    if saveType == "nand":
+        return b"CTR-SYS0" + struct.pack("<Q", saveId) + header
+    sav0Block = hashlib.sha256(b"CTR-SAV0" + header).digest()
+    return b"CTR-SIGN" + struct.pack("<Q", saveId) + sav0Block
+
+
+def decryptSave(disa, saveType, saveId, keySession, threadCount=1):
+    """ Opens an encrypted SD save for reading """
+    if saveType != "sd":
+        raise ArchiveError("only SD save supports decryption.")
+
+    if saveId is None:
+        raise ArchiveError("ID needed to decrypt the save.")
+
+    if keySession.getKeySdDecrypt() is None:
+        raise ArchiveError("No enough secrets provided to decrypt.")
+
+    high = saveId >> 32
+    low = saveId & 0xFFFFFFFF
+    path = "/title/%08x/%08x/data/00000001.sav" % (high, low)
+
+    return keySession.decryptSdFile(disa, path, threadCount)
+
+
+def decryptDiff(diff, saveType, saveId, saveSubId, keySession, threadCount=1):
+    """ Opens an encrypted SD extdata subfile or title database for reading """
+    if saveId is None:
+        raise ArchiveError("ID needed to decrypt the save.")
+
+    if keySession.getKeySdDecrypt() is None:
+        raise ArchiveError("No enough secrets provided to decrypt.")
+
+    if saveType is None:
+        raise ArchiveError("save type needed to decrypt the save.")
+    elif saveType == "extdata":
+        if saveSubId is None:
+            raise ArchiveError("sub ID needed to decrypt the save.")
+        high = saveId >> 32
+        low = saveId & 0xFFFFFFFF
+        subHigh = saveSubId >> 32
+        subLow = saveSubId & 0xFFFFFFFF
+        path = "/extdata/%08x/%08x/%08x/%08x" % (high, low, subHigh, subLow)
+    elif saveType == "titledb":
+        if saveId == 2:
+            fileName = "title.db"
+        elif saveId == 3:
+            fileName = "import.db"
+        else:
+            raise ArchiveError("Unknown title database ID %d" % saveId)
+        path = "/dbs/" + fileName
+    else:
+        raise ArchiveError("Unknown save type %s" % saveType)
+
+    return keySession.decryptSdFile(diff, path, threadCount)
+
+
+class SaveArchive(savefilesystem.FileSystem):
+    """ A SAVE, VSXE or BDRI filesystem that is parsed on first use
+
+     The FAT, hash tables and entry tables are only parsed when they are
+     first accessed. Files can be read by path through the FileSystem
+     methods, or all extracted with extractAll. close() releases the input
+     file, which lazy images still read from until then.
+    """
+
+    def __init__(self, kind, fsHeader, image, dataRegion, files=()):
+        self.kind = kind
+        self.fsHeader = fsHeader
+        self.image = image
+        self.blockSize = fsHeader.blockSize
+        self.dataRegion = dataRegion
+        self.isExtdata = kind == "extdata"
+        self.isTdb = kind == "titledb"
+        self.files = list(files)
+        self.fileRanges = {}
+
+    @functools.cached_property
+    def fat(self):
+        return savefilesystem.FAT(self.fsHeader, self.image)
+
+    @functools.cached_property
+    def dirHashTable(self):
+        return savefilesystem.getHashTable(self.fsHeader.dirHashTableOff,
+                                           self.fsHeader.dirHashTableSize,
+                                           self.image)
+
+    @functools.cached_property
+    def fileHashTable(self):
+        return savefilesystem.getHashTable(self.fsHeader.fileHashTableOff,
+                                           self.fsHeader.fileHashTableSize,
+                                           self.image)
+
+    @functools.cached_property
+    def dirList(self):
+        if self.isTdb:
+            return savefilesystem.getTdbDirList(
+                self.fsHeader, self.dataRegion, self.fat)
+        return savefilesystem.getDirList(
+            self.fsHeader, self.image, self.dataRegion, self.fat)
+
+    @functools.cached_property
+    def fileList(self):
+        if self.isTdb:
+            return savefilesystem.getTdbFileList(
+                self.fsHeader, self.dataRegion, self.fat)
+        return savefilesystem.getFileList(
+            self.fsHeader, self.image, self.dataRegion, self.fat)
+
+    def printDirList(self):
+        print("Directory list:")
+        for i in range(len(self.dirList)):
+            self.dirList[i].printEntry(i)
+
+    def printFileList(self):
+        print("File list:")
+        for i in range(len(self.fileList)):
+            if self.isTdb:
+                self.fileList[i].printEntry(i)
+            elif self.isExtdata:
+                self.fileList[i].printEntryAsExtdata(i)
+            else:
+                self.fileList[i].printEntryAsSave(i)
+
+    def verify(self):
+        """ Verifies the hash tables and walks through the free blocks """
+        print("Verifying directory hash table")
+        savefilesystem.verifyHashTable(self.dirHashTable, self.dirList)
+        print("Verifying file hash table")
+        savefilesystem.verifyHashTable(self.fileHashTable, self.fileList)
+
+        print("Walking through free blocks")
+        self.fat.visitFreeBlock()
+
+    def getFileRanges(self, fileEntry, index):
+        """ Gets the data region ranges of a file, walking its chain only once
+        """
+        if index not in self.fileRanges:
+            if fileEntry.size == 0:
+                self.fileRanges[index] = []
+            else:
+                self.fileRanges[index] = savefilesystem.getChainRanges(
+                    self.fat, fileEntry.blockIndex, self.blockSize,
+                    fileEntry.size)
+        return self.fileRanges[index]
+
+    def getFileRecord(self, fileEntry, index):
+        """ Gets what identifies the content of a file in an ExtractManifest """
+        ranges = self.getFileRanges(fileEntry, index)
+        digest = hashlib.sha256()
+        for pos, size in ranges:
+            digest.update(self.dataRegion[pos: pos + size])
+        return {"size": sum(size for _, size in ranges),
+                "chain": [list(r) for r in ranges],
+                "digest": digest.hexdigest()}
+
+    def dumpFile(self, fileEntry, file, index):
+        with extract_stats.stage("dumpFile") as record:
+            ranges = self.getFileRanges(fileEntry, index)
+            if file is not None:
+                savefilesystem.writeRanges(file, self.dataRegion, ranges)
+                record.bytes += sum(size for _, size in ranges)
+
+    def storeFile(self, store, fileEntry, file, index):
+        """ Like dumpFile, but the output is a hardlink into a BlobStore """
+        with extract_stats.stage("storeFile") as record:
+            ranges = self.getFileRanges(fileEntry, index)
+            if file is not None:
+                store.link(store.putRanges(self.dataRegion, ranges), file)
+                record.bytes += sum(size for _, size in ranges)
+
+    def extractAll(self, outputDir, fileDumper=None, manifest=None,
+                   store=None):
+        """ Extracts all files to outputDir, or only walks them if it is None
+
+         With an ExtractManifest, files whose record matches the previous
+         extraction are not rewritten, and the new records are added to it.
+         With a BlobStore, the files are stored in it and linked to.
+        """
+        if fileDumper is None:
+            if store is None:
+                fileDumper = self.dumpFile
+            else:
+                fileDumper = functools.partial(self.storeFile, store)
+        if manifest is None or outputDir is None:
+            savefilesystem.extractAll(self.dirList, self.fileList, outputDir,
+                                      fileDumper)
+            return
+
+        for path, entry, index in savefilesystem.walkTree(self.dirList,
+                                                          self.fileList):
+            fullPath = os.path.join(outputDir, path)
+            if savefilesystem.isDirEntry(entry):
+                if not os.path.isdir(fullPath):
+                    os.mkdir(fullPath)
+                continue
+
+            record = self.getFileRecord(entry, index)
+            manifest.addFile(path, record)
+            if manifest.isFileUnchanged(path, record):
+                continue
+            with savefilesystem.createOutputFile(fullPath) as file:
+                fileDumper(entry, file, index)
+
+    def close(self):
+        for file in self.files:
+            file.close()
+        self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def openDisa(filePath, saveType=None, saveId=None, decrypt=False,
+             keySession=None, threadCount=1, lazy=False, cache=None):
+    """ Opens a DISA save file
+
+     saveType is "sd", "nand" or "card". Together with saveId and the keys
+     in keySession, it enables CMAC verification and SD decryption.
+     Returns a SaveArchive. Raises ArchiveError.
+    """
+    if keySession is None:
+        keySession = key_engine.KeySession(None)
+
+    disa = open(filePath, 'rb')
+    try:
+        if decrypt:
+            disa = decryptSave(disa, saveType, saveId, keySession,
+                               threadCount)
+        return unwrapDisa(disa, saveType, saveId, keySession, threadCount,
+                          lazy, cache)
+    except BaseException:
+        disa.close()
+        raise
+
+
+@raisesArchiveError
+def unwrapDisa(disa, saveType, saveId, keySession, threadCount, lazy, cache):
+    image = mapped_file.mapFile(disa)
+
+    Cmac = image[0:0x10]
+    header = bytes(image[0x100:0x200])
+
+    if saveType is None:
+        print("No save type specified. Will skip CMAC verification.")
+    elif saveType == "nand" or saveType == "sd":
+        if saveId is None:
+            print("No save ID specified. Will skip CMAC verification.")
+        else:
+            if keySession.getKeySdNandCmac() is None:
+                print("No enough secrets provided. Will skip CMAC verification.")
+            else:
+                digest = hashlib.sha256(getSaveDigestBlock(
+                    saveType, saveId, header)).digest()
+                if Cmac != keySession.sdNandCmac(digest):
+                    raise ArchiveError("CMAC mismatch.")
+                else:
+                    print("Info: CMAC verified.")
+    else:
+        print("Unsupported save type. Will skip CMAC verification.")
+
+    # Reads DISA header
+    DISA, ver, \
+        partCount, secPartTableOff, priPartTableOff, partTableSize, \
+        partADiscriptorOff, partADiscriptorSize, \
+        partBDiscriptorOff, partBDiscriptorSize, \
+        partAOff, partASize, partBOff, partBSize, \
+        activeTable, tableHash = struct.unpack(
+            '<III4xQQQQQQQQQQQB3x32s116x', header)
+
+    if DISA != 0x41534944:
+        raise ArchiveError("Not a DISA format")
+
+    if ver != 0x00040000:
+        raise ArchiveError("Wrong DISA version")
+
+    if partCount == 1:
+        hasData = False
+        print("Info: No partition B")
+    elif partCount == 2:
+        hasData = True
+        print("Info: Has partition B")
+    else:
+        raise ArchiveError("Wrong partition count %d" % partCount)
+
+    if activeTable == 0:
+        partTableOff = priPartTableOff
+    elif activeTable == 1:
+        partTableOff = secPartTableOff
+    else:
+        raise ArchiveError("Wrong active table ID %d" % activeTable)
+
+    checkInFile(image, partTableOff, partTableSize, "partition table")
+    checkInFile(image, partAOff, partASize, "partition A")
+    if hasData:
+        checkInFile(image, partBOff, partBSize, "partition B")
+
+    # Verify partition table hash
+    partTable = image[partTableOff: partTableOff + partTableSize]
+
+    if hashlib.sha256(partTable).digest() != tableHash:
+        raise ArchiveError("Partition table hash mismatch!")
+
+    # Reads and unwraps SAVE image
+    partADescriptor = partTable[partADiscriptorOff:
+                                partADiscriptorOff + partADiscriptorSize]
+    partA = difi.sliceImage(image, partAOff, partASize)
+    partAInner, externalIVFCL4 = difi.unwrap(partADescriptor, partA,
+                                              threadCount, lazy, cache)
+    if externalIVFCL4:
+        print("Warning: partition A has an external IVFC level 4")
+
+    # Reads and unwraps DATA image
+    if hasData:
+        partBDescriptor = partTable[partBDiscriptorOff:
+                                    partBDiscriptorOff + partBDiscriptorSize]
+        partB = difi.sliceImage(image, partBOff, partBSize)
+        dataRegion, externalIVFCL4 = difi.unwrap(partBDescriptor, partB,
+                                                   threadCount, lazy, cache)
+        if not externalIVFCL4:
+            print("Warning: partition B does not have an external IVFC level 4")
+
+    # Reads SAVE header
+    SAVE, ver, filesystemHeaderOff, imageSize, imageBlockSize, x00 \
+        = struct.unpack('<IIQQII', partAInner[0:0x20])
+
+    if SAVE != 0x45564153:
+        raise ArchiveError("Wrong SAVE magic")
+
+    if ver != 0x00040000:
+        raise ArchiveError("Wrong SAVE version")
+
+    if x00 != 0:
+        print("Warning: unknown 0 = 0x%X in SAVE header" % x00)
+
+    fsHeader = savefilesystem.Header(
+        partAInner[filesystemHeaderOff:filesystemHeaderOff + 0x68], hasData)
+
+    if not hasData:
+        dataRegion = difi.sliceImage(
+            partAInner, fsHeader.dataRegionOff,
+            fsHeader.dataRegionSize * fsHeader.blockSize)
+
+    return SaveArchive("save", fsHeader, partAInner, dataRegion, [disa])
+
+
+class DiffArchive(object):
+    """ The unwrapped content of a DIFF file (extdata subfile, title database)
+    """
+
+    def __init__(self, image, uniqueId):
+        self.image = image
+        self.uniqueId = uniqueId
+
+    def read(self):
+        return bytes(self.image)
+
+
+class DiffStream(object):
+    """ The content of a DIFF file, verified while it is read
+
+     Iterating over it yields the content in order in chunks of 1 MiB, and
+     can only be done once. The input file stays open until then, or until
+     close(). The time spent waiting for each chunk to be verified is
+     recorded as the difi.waitStream stage, so that the rest of dumpFile is
+     the time spent writing.
+    """
+
+    def __init__(self, chunks, size, uniqueId, file):
+        self.chunks = chunks
+        self.size = size
+        self.uniqueId = uniqueId
+        self.file = file
+
+    def __iter__(self):
+        try:
+            while True:
+                with extract_stats.stage("difi.waitStream") as record:
+                    chunk = next(self.chunks, None)
+                    if chunk is not None:
+                        record.bytes += len(chunk)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def writeTo(self, file):
+        """ Writes the content to file, or only verifies it if file is None """
+        for chunk in self:
+            if file is not None:
+                file.write(chunk)
+
+    def read(self):
+        return b''.join(self)
+
+    def close(self):
+        self.file.close()
+
+
+def writeDiff(diff, outputPath, store=None):
+    """ Writes a DiffStream to outputPath as it is verified
+
+     With store, the content goes into the blob store and outputPath is
+     linked to it. Without outputPath, the content is only verified.
+    """
+    if outputPath is None:
+        diff.writeTo(None)
+        return
+    with extract_stats.stage("dumpFile" if store is None else "storeFile",
+                             diff.size):
+        with savefilesystem.createOutputFile(outputPath) as file:
+            if store is not None:
+                store.link(store.putChunks(diff), file)
+            else:
+                diff.writeTo(file)
+
+
+def getJobResult(future, function, job, initializer, initargs=()):
+    """ Gets the result of function(job) submitted to a process pool
+
+     A worker that dies breaks the whole pool and every job that was still
+     pending in it. Such a job is run again in a process of its own, so
+     that only the job that takes its worker down fails. Raises whatever
+     the job or its worker raised.
+    """
+    try:
+        return future.result()
+    except concurrent.futures.process.BrokenProcessPool:
+        pass
+    with concurrent.futures.ProcessPoolExecutor(
+            1, initializer=initializer, initargs=initargs) as executor:
+        return executor.submit(function, job).result()
+
+
+def openDiff(filePath, expectedUniqueId=None, saveType=None, saveId=None,
+             saveSubId=None, decrypt=False, keySession=None, threadCount=1,
+             cache=None, stream=False):
+    """ Opens a DIFF file and verifies its content
+
+     saveType is "extdata" or "titledb". Together with saveId, saveSubId and
+     the keys in keySession, it enables CMAC verification and SD decryption.
+     Returns a DiffArchive, or with stream, a DiffStream that verifies the
+     content as it is read. Raises ArchiveError.
+    """
+    if keySession is None:
+        keySession = key_engine.KeySession(None)
+
+    diff = open(filePath, 'rb')
+    try:
+        if decrypt:
+            diff = decryptDiff(diff, saveType, saveId, saveSubId, keySession,
+                               threadCount)
+        archive = unwrapDiff(diff, expectedUniqueId, saveType, saveId,
+                             saveSubId, keySession, threadCount, cache, stream)
+    except BaseException:
+        diff.close()
+        raise
+    if not stream:
+        diff.close()
+    return archive
+
+
+@raisesArchiveError
+def unwrapDiff(diff, expectedUniqueId, saveType, saveId, saveSubId,
+               keySession, threadCount, cache, stream=False):
+    image = mapped_file.mapFile(diff)
+
+    Cmac = image[0:0x10]
+    header = bytes(image[0x100:0x200])
+
+    digestBlock = None
+    if keySession.getKeySdNandCmac() is None:
+        print("No enough secrets provided. Will skip CMAC verification.")
+    elif saveType is None:
+        print("No save type specified. Will skip CMAC verification.")
+    elif saveId is None:
+        print("No save ID specified. Will skip CMAC verification.")
+    elif saveType == "extdata":
+        if saveSubId is None:
+            saveSubId = 0
+            quotaFlag = 0
+        else:
+            quotaFlag = 1
+        digestBlock = b"CTR-EXT0" + \
+            struct.pack("<QIQ", saveId, quotaFlag, saveSubId) + header
+    elif saveType == "titledb":
+        digestBlock = b"CTR-9DB0" + struct.pack("<I", saveId) + header
+    else:
+        print("Unknown save type. Will skip CMAC verification.")
+
+    if digestBlock is not None:
+        if Cmac != keySession.sdNandCmac(hashlib.sha256(digestBlock).digest()):
+            raise ArchiveError("CMAC mismatch.")
+        else:
+            print("Info: CMAC verified.")
+
+    DIFF, ver, \
+        secPartTableOff, priPartTableOff, partTableSize, \
+        partOff, partSize, \
+        activeTable, tableHash, uniqueId, \
+        = struct.unpack('<IIQQQQQI32sQ164x', header)
+
+    if DIFF != 0x46464944:
+        raise ArchiveError("Not a DIFF format")
+
+    if ver != 0x00030000:
+        raise ArchiveError("Wrong DIFF version")
+
+    if activeTable == 0:
+        partTableOff = priPartTableOff
+    elif activeTable == 1:
+        partTableOff = secPartTableOff
+    else:
+        raise ArchiveError("Wrong active table ID %d" % activeTable)
+
+    print("Info: Unique ID = %016X" % uniqueId)
+    if expectedUniqueId is not None:
+        if expectedUniqueId != uniqueId:
+            print("Warning: unique ID mismatch")
+
+    checkInFile(image, partTableOff, partTableSize, "partition table")
+    checkInFile(image, partOff, partSize, "partition")
+
+    # Verify partition table hash
+    partTable = image[partTableOff: partTableOff + partTableSize]
+    if hashlib.sha256(partTable).digest() != tableHash:
+        raise ArchiveError("Partition table hash mismatch!")
+
+    # Reads and unwraps partition
+    part = difi.sliceImage(image, partOff, partSize)
+    if stream:
+        chunks, size, externalIVFCL4 = difi.unwrapStream(
+            partTable, part, threadCount, cache)
+    else:
+        inner, externalIVFCL4 = difi.unwrap(partTable, part, threadCount,
+                                            cache=cache)
+    if externalIVFCL4:
+        print("Info: external IVFC level 4")
+
+    if stream:
+        return DiffStream(chunks, size, uniqueId, diff)
+    return DiffArchive(inner, uniqueId)
+
+
+class ExtdataArchive(SaveArchive):
+    """ An extdata directory: the VSXE filesystem of its subfile 1
+
+     The files listed in the VSXE are stored in separate DIFF subfiles. read
+     and openSubfile unwrap them on demand.
+    """
+
+    dirCapacity = 126  # ???
+
+    def __init__(self, fsHeader, image, dataRegion, extdataDir, saveId,
+                 decrypt, keySession, threadCount, cache):
+        super().__init__("extdata", fsHeader, image, dataRegion)
+        self.extdataDir = extdataDir
+        self.saveId = saveId
+        self.decrypt = decrypt
+        self.keySession = keySession
+        self.threadCount = threadCount
+        self.cache = cache
+
+    def getSubfileId(self, index):
+        """ Gets (ID high, ID low) of the subfile of a file entry index """
+        fileId = index + 1
+        return (fileId // self.dirCapacity, fileId % self.dirCapacity)
+
+    def getSubfilePath(self, idHigh, idLow):
+        return os.path.join(self.extdataDir, "%08x" % idHigh, "%08x" % idLow)
+
+    def openSubfile(self, index, stream=False):
+        """ Opens the subfile of a file entry index as a DiffArchive
+
+         With stream, it is opened as a DiffStream instead.
+        """
+        idHigh, idLow = self.getSubfileId(index)
+        return openDiff(self.getSubfilePath(idHigh, idLow),
+                        expectedUniqueId=self.fileList[index].uniqueId,
+                        saveType="extdata", saveId=self.saveId,
+                        saveSubId=(idHigh << 32) | idLow,
+                        decrypt=self.decrypt, keySession=self.keySession,
+                        threadCount=self.threadCount, cache=self.cache,
+                        stream=stream)
+
+    def getFileRecord(self, fileEntry, index):
+        idHigh, idLow = self.getSubfileId(index)
+        return {"uniqueId": fileEntry.uniqueId,
+                "header": extract_manifest.getHeaderDigest(
+                    self.getSubfilePath(idHigh, idLow))}
+
+    def dumpFile(self, fileEntry, file, index):
+        print("Extracting %s" % fileEntry.getName())
+        with extract_stats.stage("dumpFile") as record:
+            subfile = self.openSubfile(index, stream=True)
+            subfile.writeTo(file)
+            if file is not None:
+                record.bytes += subfile.size
+
+    def storeFile(self, store, fileEntry, file, index):
+        print("Extracting %s" % fileEntry.getName())
+        with extract_stats.stage("storeFile") as record:
+            subfile = self.openSubfile(index, stream=True)
+            if file is not None:
+                store.link(store.putChunks(subfile), file)
+                record.bytes += subfile.size
+            else:
+                subfile.writeTo(None)
+
+    def read(self, path):
+        isDir, index = self.lookup(path)
+        if isDir:
+            raise IsADirectoryError(path)
+        return self.openSubfile(index).read()
+
+
+@raisesArchiveError
+def openExtdata(extdataDir, saveId=None, decrypt=False, keySession=None,
+                threadCount=1, cache=None):
+    """ Opens an extdata directory (extdata/<ID high>/<ID low>)
+
+     Returns an ExtdataArchive. Raises ArchiveError.
+    """
+    if keySession is None:
+        keySession = key_engine.KeySession(None)
+
+    vsxe = openDiff(os.path.join(extdataDir, "00000000", "00000001"),
+                    saveType="extdata", saveId=saveId, saveSubId=1,
+                    decrypt=decrypt, keySession=keySession,
+                    threadCount=threadCount, cache=cache).image
+
+    # Reads VSXE header
+    VSXE, ver, filesystemHeaderOff, imageSize, imageBlockSize, x00, \
+        unk1, recentAction, unk2, recentId, unk3, recentPath \
+        = struct.unpack('<IIQQIIQIIII256s', vsxe[0:0x138])
+
+    if VSXE != 0x45585356:
+        raise ArchiveError("Wrong VSXE magic")
+
+    if ver != 0x00030000:
+        raise ArchiveError("Wrong VSXE version")
+
+    if x00 != 0:
+        print("Warning: unknown 0 = 0x%X in VSXE header" % x00)
+
+    print("Info: unk1 = %d" % unk1)
+    print("Info: recent action = %d" % recentAction)
+    print("Info: unk2 = %d" % unk2)
+    print("Info: recent ID = %d" % recentId)
+    print("Info: unk3 = %d" % unk3)
+    print("Info: recentPath = %s" %
+          savefilesystem.trimBytes(recentPath).decode())
+
+    fsHeader = savefilesystem.Header(
+        vsxe[filesystemHeaderOff:filesystemHeaderOff + 0x68], False)
+
+    dataRegion = vsxe[
+        fsHeader.dataRegionOff: fsHeader.dataRegionOff +
+        fsHeader.dataRegionSize * fsHeader.blockSize]
+
+    return ExtdataArchive(fsHeader, vsxe, dataRegion, extdataDir, saveId,
+                          decrypt, keySession, threadCount, cache)
+
+
+def openTitleDb(filePath):
+    """ Opens an unwrapped title database image (the content of a *.db DIFF)
+
+     Returns a SaveArchive. Raises ArchiveError.
+    """
+    with open(filePath, 'rb') as file:
+        image = file.read()
+    return parseTitleDb(memoryview(image))
+
+
+def openTitleDbDiff(filePath, saveId=None, decrypt=False, keySession=None,
+                    threadCount=1, cache=None):
+    """ Opens a title database DIFF file (ticket.db, title.db, import.db...)
+
+     The DIFF is unwrapped and its BDRI image parsed in memory, without
+     writing the image out. saveId is 2 for title.db and 3 for import.db on
+     SD, and is needed for decryption and CMAC verification. Returns a
+     SaveArchive. Raises ArchiveError.
+    """
+    image = openDiff(filePath, saveType="titledb", saveId=saveId,
+                     decrypt=decrypt, keySession=keySession,
+                     threadCount=threadCount, cache=cache).image
+    return parseTitleDb(image)
+
+
+def isDiffFile(filePath):
+    """ Checks if a file starts like a DIFF file rather than an unwrapped image
+    """
+    with open(filePath, 'rb') as file:
+        return file.read(0x104)[0x100:] == b"DIFF"
+
+
+@raisesArchiveError
+def parseTitleDb(image):
+    """ Parses an unwrapped title database image
+
+     image is only sliced, so a memoryview is parsed without copies.
+    """
+    magic, magic2, b, c = struct.unpack('<IIII', image[0:0x10])
+    if magic == 0x4B434954:
+        print("Info: magic = TICK")
+        preHeaderSize = 0x10
+    elif magic == 0x444E414E:
+        print("Info: magic = NAND")
+        preHeaderSize = 0x80
+    elif magic == 0x504D4554:
+        print("Info: magic = TEMP")
+        preHeaderSize = 0x80
+    else:
+        raise ArchiveError("unknown magic")
+
+    print("Info: Pre Header 0x%08X 0x%08X 0x%08X" % (magic2, b, c))
+
+    dbri = image[preHeaderSize:]
+
+    BDRI, ver, filesystemHeaderOff, imageSize, imageBlockSize, x00 \
+        = struct.unpack('<IIQQII', dbri[0:0x20])
+
+    if BDRI != 0x49524442:
+        raise ArchiveError("Wrong BDRI magic")
+
+    if ver != 0x00030000:
+        raise ArchiveError("Wrong BDRI version")
+
+    if x00 != 0:
+        print("Warning: unknown 0 = 0x%X in BDRI header" % x00)
+
+    fsHeader = savefilesystem.Header(
+        dbri[filesystemHeaderOff: filesystemHeaderOff+0x68], False)
+
+    dataRegion = dbri[
+        fsHeader.dataRegionOff: fsHeader.dataRegionOff +
+        fsHeader.dataRegionSize * fsHeader.blockSize]
+
+    return SaveArchive("titledb", fsHeader, dbri, dataRegion)
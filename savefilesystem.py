@@ -1,6 +1,18 @@
 import os
 import os.path
 import struct
+import sys
+import array
+
+import extract_stats
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FAT_FLAG = 0x80000000
+FAT_INDEX = 0x7FFFFFFF
 
 
 def trimBytes(bs):
@@ -49,36 +61,65 @@ class Header(object):
         print("Info: fileMaxCount = %d" % self.fileMaxCount)
 
 
+def getNameHash(parentIndex, name):
+    """ Hashes a parent index and a 16-byte zero-padded name """
+    hash = parentIndex ^ 0x091A2B3C
+    for i in range(4):
+        hash = ((hash >> 1) | (hash << 31)) & 0xFFFFFFFF
+        hash ^= name[i * 4]
+        hash ^= name[i * 4 + 1] << 8
+        hash ^= name[i * 4 + 2] << 16
+        hash ^= name[i * 4 + 3] << 24
+    return hash
+
+
+def getTitleIdHash(parentIndex, titleId):
+    """ Hashes a parent index and a title ID, for title databases """
+    hash = parentIndex ^ 0x091A2B3C
+    hash = ((hash >> 1) | (hash << 31)) & 0xFFFFFFFF
+    hash ^= titleId & 0xFFFFFFFF
+    hash = ((hash >> 1) | (hash << 31)) & 0xFFFFFFFF
+    hash ^= titleId >> 32
+    return hash
+
+
 class HashableEntry(object):
-    """ A common hash function for directory and file entries """
+    """ A common hash function for directory and file entries
+
+     The hash is computed for the whole table at once by getTableHashes and
+     stored in each entry when the table is parsed.
+    """
+
+    __slots__ = ()
 
     def getHash(self):
-        hash = self.parentIndex ^ 0x091A2B3C
-        for i in range(4):
-            hash = ((hash >> 1) | (hash << 31)) & 0xFFFFFFFF
-            hash ^= self.name[i * 4]
-            hash ^= self.name[i * 4 + 1] << 8
-            hash ^= self.name[i * 4 + 2] << 16
-            hash ^= self.name[i * 4 + 3] << 24
-        return hash
+        return self.hash
 
 
 class DirEntry(HashableEntry):
     """ Directory table entry """
 
-    def __init__(self, raw):
+    __slots__ = ('parentIndex', 'name', 'nextIndex', 'firstDirIndex',
+                 'firstFileIndex', 'unknown', 'nextCollision',
+                 'count', 'maxCount', 'nextDummyIndex', 'isDummy', 'hash')
+
+    format = struct.Struct('<I16sIIIII')
+    hashColumns = (1, 2, 3, 4)  # the name as four u32
+
+    def __init__(self, fields):
         # Reads normal entry data
         self.parentIndex, self.name, \
             self.nextIndex, self.firstDirIndex, self.firstFileIndex, \
             self.unknown, self.nextCollision \
-            = struct.unpack('<I16sIIIII', raw)
+            = fields
 
         if self.unknown != 0:
             print("Warning: unknown = %d" % self.unknown)
 
         # Reads dummy entry data
-        self.count, self.maxCount, self.nextDummyIndex \
-            = struct.unpack('<II28xI', raw)
+        self.count = self.parentIndex
+        self.maxCount = int.from_bytes(self.name[0:4], 'little')
+        self.nextDummyIndex = self.nextCollision
 
         self.isDummy = False  # will be set later
 
@@ -105,19 +146,27 @@ class DirEntry(HashableEntry):
 class FileEntry(HashableEntry):
     """ File table entry """
 
-    def __init__(self, raw):
+    __slots__ = ('parentIndex', 'name', 'nextIndex', 'blockIndex', 'size',
+                 'u2', 'nextCollision', 'uniqueId',
+                 'count', 'maxCount', 'nextDummyIndex', 'isDummy', 'hash')
+
+    format = struct.Struct('<I16sI4xIQII')
+    hashColumns = (1, 2, 3, 4)  # the name as four u32
+
+    def __init__(self, fields):
         # Reads normal entry data
         self.parentIndex, self.name, \
             self.nextIndex, self.blockIndex, self.size, \
             self.u2, self.nextCollision \
-            = struct.unpack('<I16sI4xIQII', raw)
+            = fields
 
         # for extdata
         self.uniqueId = self.size
 
         # Reads dummy entry data
-        self.count, self.maxCount, self.nextDummyIndex \
-            = struct.unpack('<II36xI', raw)
+        self.count = self.parentIndex
+        self.maxCount = int.from_bytes(self.name[0:4], 'little')
+        self.nextDummyIndex = self.nextCollision
 
         self.isDummy = False  # will be set later
 
@@ -154,27 +203,32 @@ class FileEntry(HashableEntry):
 
 
 class TdbHashableEntry(object):
+    __slots__ = ()
+
     def getHash(self):
-        hash = self.parentIndex ^ 0x091A2B3C
-        hash = ((hash >> 1) | (hash << 31)) & 0xFFFFFFFF
-        hash ^= self.titleId & 0xFFFFFFFF
-        hash = ((hash >> 1) | (hash << 31)) & 0xFFFFFFFF
-        hash ^= self.titleId >> 32
-        return hash
+        return self.hash
 
 
 class TdbDirEntry(TdbHashableEntry):
     """ Tite database directory table entry """
 
-    def __init__(self, raw):
+    __slots__ = ('parentIndex', 'nextIndex', 'firstDirIndex', 'firstFileIndex',
+                 'unk1', 'unk2', 'unk3', 'nextCollision', 'titleId',
+                 'count', 'maxCount', 'nextDummyIndex', 'isDummy', 'hash')
+
+    format = struct.Struct('<IIIIIIII')
+    hashColumns = (None, None)  # title ID 0
+
+    def __init__(self, fields):
         # Reads normal entry data
         self.parentIndex, self.nextIndex, self.firstDirIndex, self.firstFileIndex, \
             self.unk1, self.unk2, self.unk3, self.nextCollision \
-            = struct.unpack('<IIIIIIII', raw)
+            = fields
 
         # Reads dummy entry data
-        self.count, self.maxCount, self.nextDummyIndex \
-            = struct.unpack('<II20xI', raw)
+        self.count = self.parentIndex
+        self.maxCount = self.nextIndex
+        self.nextDummyIndex = self.nextCollision
 
         self.titleId = 0
 
@@ -203,16 +257,24 @@ class TdbDirEntry(TdbHashableEntry):
 class TdbFileEntry(TdbHashableEntry):
     """ Title databse file table entry """
 
-    def __init__(self, raw):
+    __slots__ = ('parentIndex', 'titleId', 'nextIndex', 'unk1', 'blockIndex',
+                 'size', 'unk2', 'unk3', 'nextCollision',
+                 'count', 'maxCount', 'nextDummyIndex', 'isDummy', 'hash')
+
+    format = struct.Struct('<IQIIIQIII')
+    hashColumns = (1, 2)  # the title ID as two u32
+
+    def __init__(self, fields):
         # Reads normal entry data
         self.parentIndex, self.titleId, \
             self.nextIndex, self.unk1, self.blockIndex, self.size, \
             self.unk2, self.unk3, self.nextCollision \
-            = struct.unpack('<IQIIIQIII', raw)
+            = fields
 
         # Reads dummy entry data
-        self.count, self.maxCount, self.nextDummyIndex \
-            = struct.unpack('<II32xI', raw)
+        self.count = self.parentIndex
+        self.maxCount = self.titleId & 0xFFFFFFFF
+        self.nextDummyIndex = self.nextCollision
 
         self.isDummy = False  # will be set later
 
@@ -238,99 +300,243 @@ class TdbFileEntry(TdbHashableEntry):
         return 0x2C
 
 
-class FATEntry(object):
-    """ FAT entry """
-
-    def __init__(self, raw):
-        self.u, self.v = struct.unpack('II', raw)
-        if self.u >= 0x80000000:
-            self.u -= 0x80000000
-            self.uFlag = True
-        else:
-            self.uFlag = False
-        if self.v >= 0x80000000:
-            self.v -= 0x80000000
-            self.vFlag = True
+def readWords(data):
+    """ Reads little-endian u32 words into an array """
+    words = array.array('I')
+    words.frombytes(data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+
+def getTableHashes(table, EntryT):
+    """ Computes the hash of every entry of a raw entry table at once
+
+     The table is viewed as rows of u32 words. The parent index is in column
+     0 and the hashed name or title ID in EntryT.hashColumns. With NumPy,
+     each step runs over the whole table. Otherwise each column is taken
+     out of a flat array and combined in a list comprehension.
+    """
+    stride = EntryT.entrySize() // 4
+    if numpy is not None:
+        words = numpy.frombuffer(table, '<u4').reshape(-1, stride)
+        hash = words[:, 0] ^ numpy.uint32(0x091A2B3C)
+        for column in EntryT.hashColumns:
+            hash = (hash >> numpy.uint32(1)) | (hash << numpy.uint32(31))
+            if column is not None:
+                hash ^= words[:, column]
+        return hash.tolist()
+
+    words = readWords(table)
+    hashes = [parent ^ 0x091A2B3C for parent in words[0::stride]]
+    for column in EntryT.hashColumns:
+        if column is None:
+            hashes = [((hash >> 1) | (hash << 31)) & 0xFFFFFFFF
+                      for hash in hashes]
         else:
-            self.vFlag = False
+            hashes = [(((hash >> 1) | (hash << 31)) & 0xFFFFFFFF) ^ word
+                      for hash, word in zip(hashes, words[column::stride])]
+    return hashes
+
+
+def getEntryList(data, offset, EntryT):
+    """ Parses an entry table in one pass
 
-        self.visited = False
+     The entry count is read from the first (dummy) entry.
+    """
+    size = EntryT.entrySize()
+    count = struct.unpack('<I', data[offset: offset + 4])[0]
+    table = data[offset: offset + max(count, 1) * size]
+    entryList = [EntryT(fields) for fields in EntryT.format.iter_unpack(table)]
+    for entry, hash in zip(entryList, getTableHashes(table, EntryT)):
+        entry.hash = hash
+    return entryList
 
 
 class FAT(object):
+    """ File allocation table
+
+     The table is parsed in one pass into flat arrays. u and v hold the raw
+     u32 words of each entry, so the index is word & 0x7FFFFFFF and the flag
+     is bit 31 (FAT_FLAG). Walked entries are marked in the visited bitmap.
+
+     Every problem found while walking is recorded in anomalies as (kind,
+     entry index) and printed as a warning, up to MAX_CHAIN_WARNINGS per
+     chain. A walk never reads outside the table, stops when a chain comes
+     back to one of its own nodes, and stops after as many blocks as there
+     are in the table, so a corrupted FAT cannot make it loop. A marking
+     walk also stops at the first block marked by an earlier walk, and all
+     marking walks share a budget of one step per entry, so chains that
+     merge into each other are only walked once.
+    """
+
+    MAX_CHAIN_WARNINGS = 16
+
     def __init__(self, fsHeader, partitionImage):
-        self.fatList = []
-        for i in range(0, fsHeader.fatSize + 1):  # the actual FAT size is one larger
-            self.fatList.append(FATEntry(
-                partitionImage[fsHeader.fatOff + i * 8: fsHeader.fatOff + (i + 1) * 8]))
+        count = fsHeader.fatSize + 1  # the actual FAT size is one larger
+        with extract_stats.stage("savefilesystem.FAT", count * 8):
+            words = array.array('I')
+            words.frombytes(partitionImage[
+                fsHeader.fatOff: fsHeader.fatOff + count * 8])
+            if sys.byteorder == 'big':
+                words.byteswap()
+            self.u = words[0::2]
+            self.v = words[1::2]
+        self.visited = bytearray(count)
+        self.stepsLeft = count
+        self.anomalies = []
+
+    def report(self, kind, index, message, quiet=False):
+        if not quiet:
+            print("Warning: " + message)
+        self.anomalies.append((kind, index))
+
+    def getExtents(self, start, mark=True):
+        """ Walks a chain and gets its blocks as a list of (first block, count)
+
+         Nodes that follow each other in the data region are merged into one
+         extent. Unless mark is False, the blocks are marked visited.
+        """
+        u = self.u
+        v = self.v
+        visited = self.visited
+        count = len(u)
+        extents = []
+        nodes = set()
+        blockCount = 0
+        warningCount = 0
+
+        def report(kind, index, message):
+            nonlocal warningCount
+            warningCount += 1
+            self.report(kind, index, message,
+                        warningCount > self.MAX_CHAIN_WARNINGS)
 
-    def walk(self, start, blockHandler):
         start += 1  # shift index
         current = start
         previous = 0
         while current != 0:
+            if current >= count:
+                report("out of range", previous,
+                       "node out of range @ %i" % previous)
+                break
+            if current in nodes:
+                report("cycle", current, "chain loops @ %i" % current)
+                break
+            nodes.add(current)
+            if mark and visited[current]:
+                report("already visited", current,
+                       "already visited @ %i" % current)
+                break
+
             if current == start:
-                if not self.fatList[current].uFlag:
-                    print("Warning: first node not marked start @ %i" % current)
+                if not u[current] & FAT_FLAG:
+                    report("start not marked", current,
+                           "first node not marked start @ %i" % current)
             else:
-                if self.fatList[current].uFlag:
-                    print("Warning: other node marked start @ %i" % current)
-            if self.fatList[current].u != previous:
-                print("Warning: previous node mismatch @ %i" % current)
-
-            if self.fatList[current].vFlag:
-                nodeEnd = self.fatList[current + 1].v
-                if self.fatList[current + 1].u != current:
-                    print("Warning: expansion node first block mismatch @ %i" %
-                          (current + 1))
-                if not self.fatList[current + 1].uFlag:
-                    print("Warning: expansion node first block not marked @ %i" % (
-                        current + 1))
-                if self.fatList[current + 1].vFlag:
-                    print("Warning: expansion node first block with wrong mark @ %i" % (
-                        current + 1))
-                if self.fatList[nodeEnd].u != current or \
-                        self.fatList[nodeEnd].v != nodeEnd:
-                    print("Warning: expansion node last block mismatch @ %i" % nodeEnd)
-                if not self.fatList[nodeEnd].uFlag:
-                    print(
-                        "Warning: expansion node first block not marked @ %i" % nodeEnd)
-                if self.fatList[nodeEnd].vFlag:
-                    print(
-                        "Warning: expansion node last block with wrong mark @ %i" % nodeEnd)
+                if u[current] & FAT_FLAG:
+                    report("other marked start", current,
+                           "other node marked start @ %i" % current)
+            if u[current] & FAT_INDEX != previous:
+                report("previous mismatch", current,
+                       "previous node mismatch @ %i" % current)
+
+            if v[current] & FAT_FLAG:
+                if current + 1 >= count or \
+                        not current < v[current + 1] & FAT_INDEX < count:
+                    report("bad expansion", current,
+                           "expansion node out of range @ %i" % current)
+                    break
+                nodeEnd = v[current + 1] & FAT_INDEX
+                if u[current + 1] & FAT_INDEX != current:
+                    report("expansion mismatch", current + 1,
+                           "expansion node first block mismatch @ %i" %
+                           (current + 1))
+                if not u[current + 1] & FAT_FLAG:
+                    report("expansion not marked", current + 1,
+                           "expansion node first block not marked @ %i" % (
+                               current + 1))
+                if v[current + 1] & FAT_FLAG:
+                    report("expansion wrong mark", current + 1,
+                           "expansion node first block with wrong mark @ %i" % (
+                               current + 1))
+                if u[nodeEnd] & FAT_INDEX != current or \
+                        v[nodeEnd] & FAT_INDEX != nodeEnd:
+                    report("expansion mismatch", nodeEnd,
+                           "expansion node last block mismatch @ %i" % nodeEnd)
+                if not u[nodeEnd] & FAT_FLAG:
+                    report("expansion not marked", nodeEnd,
+                           "expansion node first block not marked @ %i" % nodeEnd)
+                if v[nodeEnd] & FAT_FLAG:
+                    report("expansion wrong mark", nodeEnd,
+                           "expansion node last block with wrong mark @ %i" % nodeEnd)
             else:
                 nodeEnd = current
 
-            for i in range(current, nodeEnd + 1):
-                if self.fatList[i].visited:
-                    print("Warning: already visited @ %i" % i)
-                blockHandler(i - 1)  # shift index back
-                self.fatList[i].visited = True
+            blockCount += nodeEnd + 1 - current
+            if blockCount > count:
+                report("too long", current,
+                       "chain longer than the FAT @ %i" % current)
+                break
+
+            if mark:
+                i = visited.find(1, current, nodeEnd + 1)
+                if i != -1:
+                    report("already visited", i, "already visited @ %i" % i)
+                    break
+                self.stepsLeft -= 1
+                if self.stepsLeft < 0:
+                    report("budget exhausted", current,
+                           "FAT walk budget exhausted @ %i" % current)
+                    break
+                visited[current: nodeEnd + 1] = \
+                    b'\x01' * (nodeEnd + 1 - current)
+
+            # shift index back
+            if extents and sum(extents[-1]) == current - 1:
+                extents[-1] = (extents[-1][0], extents[-1][1] +
+                               nodeEnd + 1 - current)
+            else:
+                extents.append((current - 1, nodeEnd + 1 - current))
 
             previous = current
-            current = self.fatList[current].v
+            current = v[current] & FAT_INDEX
+
+        if warningCount > self.MAX_CHAIN_WARNINGS:
+            print("Warning: %d more problems in the chain @ %i not shown" % (
+                warningCount - self.MAX_CHAIN_WARNINGS, start - 1))
+        return extents
+
+    def walk(self, start, blockHandler):
+        """ Calls blockHandler on each block of a chain
+
+         Returns the anomalies found in the chain.
+        """
+        anomalyCount = len(self.anomalies)
+        for first, count in self.getExtents(start):
+            for i in range(first, first + count):
+                blockHandler(i)
+        return self.anomalies[anomalyCount:]
 
     def visitFreeBlock(self):
-        self.fatList[0].visited = True
-        if self.fatList[0].u != 0:
-            print("Warning: free leading block has u = %d" % fatList[0].u)
-        if self.fatList[0].uFlag or self.fatList[0].vFlag:
-            print("Warning: free leading block has flag set")
-        start = self.fatList[0].v
-        self.walk(start - 1, lambda _: None)
+        self.visited[0] = 1
+        if self.u[0] & FAT_INDEX != 0:
+            self.report("free leading", 0, "free leading block has u = %d" %
+                        (self.u[0] & FAT_INDEX))
+        if self.u[0] & FAT_FLAG or self.v[0] & FAT_FLAG:
+            self.report("free leading", 0, "free leading block has flag set")
+        start = self.v[0] & FAT_INDEX
+        self.getExtents(start - 1)
 
     def allVisited(self):
-        for i in range(len(self.fatList)):
-            if not self.fatList[i].visited:
-                print("Warning: block %d not visited" % i)
+        i = self.visited.find(0)
+        while i != -1:
+            self.report("not visited", i, "block %d not visited" % i)
+            i = self.visited.find(0, i + 1)
 
 
 def getHashTable(offset, size, partitionImage):
-    hashTable = []
-    for i in range(size):
-        hashTable.append(struct.unpack('<I', partitionImage[
-            offset + i * 4: offset + (i + 1) * 4])[0])
-    return hashTable
+    return readWords(partitionImage[offset: offset + size * 4]).tolist()
 
 
 def scanDummyEntry(list):
@@ -345,36 +551,89 @@ def scanDummyEntry(list):
         i = list[i].nextDummyIndex
 
 
-def getAllocatedList(dataRegion, blockSize, fat, index, count):
-    result = bytearray()
-    left = count
+def getChainRanges(fat, index, blockSize, size, mark=True):
+    """ Maps the first size bytes of a chain to (offset, size) data ranges
 
-    def transferBlock(i):
-        nonlocal count
-        if count == 0:
+     There is one range per extent of the chain, instead of one per block.
+    """
+    ranges = []
+    for first, count in fat.getExtents(index, mark):
+        tranSize = min(size, count * blockSize)
+        if tranSize != 0:
+            ranges.append((first * blockSize, tranSize))
+        size -= tranSize
+        for _ in range(count - (tranSize + blockSize - 1) // blockSize):
             print("Warning: excessive block")
-            return
-        result.extend(dataRegion[blockSize * i: blockSize * (i + 1)])
-        count -= 1
-    fat.walk(index, transferBlock)
-    if count != 0:
+    if size != 0:
         print("Warning: not enough block")
+    return ranges
+
+
+def writeRanges(file, dataRegion, ranges):
+    """ Writes (offset, size) ranges of the data region back to back to a file
+
+     The ranges are sliced as memoryviews and handed to os.pwritev, so no
+     per-block copies are made. They are written at the current position of
+     the file, which is sized up front and left positioned after them, as
+     with file.write. Where pwritev is not available, each range is written
+     separately.
+    """
+    buffers = [memoryview(dataRegion[pos: pos + size]) for pos, size in ranges]
+    total = sum(buffer.nbytes for buffer in buffers)
+    if not hasattr(os, "pwritev"):
+        for buffer in buffers:
+            file.write(buffer)
+        return
+
+    file.flush()
+    fd = file.fileno()
+    start = file.tell()
+    allocated = False
+    if total != 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, start, total)
+            allocated = True
+        except OSError:
+            pass  # not supported by the file system
+    if total != 0 and not allocated and os.fstat(fd).st_size < start + total:
+        os.ftruncate(fd, start + total)
+
+    try:
+        iovMax = os.sysconf("SC_IOV_MAX")
+    except (ValueError, OSError):
+        iovMax = 1024
+
+    pos = start
+    i = 0
+    while i < len(buffers):
+        written = os.pwritev(fd, buffers[i: i + iovMax], pos)
+        pos += written
+        while i < len(buffers) and written >= buffers[i].nbytes:
+            written -= buffers[i].nbytes
+            i += 1
+        if written != 0:
+            buffers[i] = buffers[i][written:]
+    file.seek(start + total)
+
+
+def getAllocatedList(dataRegion, blockSize, fat, index, count):
+    result = bytearray()
+    for pos, size in getChainRanges(fat, index, blockSize, count * blockSize):
+        result.extend(dataRegion[pos: pos + size])
     return result
 
 
 def getDirList(fsHeader, partitionImage, dataRegion, fat, DirEntryT=DirEntry):
-    offset = fsHeader.dirTableOff
-    if fsHeader.tableInDataRegion:
-        data = getAllocatedList(dataRegion, fsHeader.blockSize, fat,
-                                fsHeader.dirTableBlockIndex, fsHeader.dirTableBlockCount)
-    else:
-        data = partitionImage
-    dirList = [DirEntryT(data[offset: offset + DirEntryT.entrySize()])]
-    dirCount = dirList[0].count
-    for i in range(1, dirCount):
-        dirList.append(DirEntryT(data[
-            offset + i * DirEntryT.entrySize(): offset + (i + 1) * DirEntryT.entrySize()]))
-    scanDummyEntry(dirList)
+    with extract_stats.stage("savefilesystem.getDirList") as record:
+        offset = fsHeader.dirTableOff
+        if fsHeader.tableInDataRegion:
+            data = getAllocatedList(dataRegion, fsHeader.blockSize, fat,
+                                    fsHeader.dirTableBlockIndex, fsHeader.dirTableBlockCount)
+        else:
+            data = partitionImage
+        dirList = getEntryList(data, offset, DirEntryT)
+        scanDummyEntry(dirList)
+        record.bytes += len(dirList) * DirEntryT.entrySize()
     return dirList
 
 
@@ -383,18 +642,16 @@ def getTdbDirList(fsHeader, dataRegion, fat):
 
 
 def getFileList(fsHeader, partitionImage, dataRegion, fat, FileEntryT=FileEntry):
-    offset = fsHeader.fileTableOff
-    if fsHeader.tableInDataRegion:
-        data = getAllocatedList(dataRegion, fsHeader.blockSize, fat,
-                                fsHeader.fileTableBlockIndex, fsHeader.fileTableBlockCount)
-    else:
-        data = partitionImage
-    fileList = [FileEntryT(data[offset: offset + FileEntryT.entrySize()])]
-    fileCount = fileList[0].count
-    for i in range(1, fileCount):
-        fileList.append(FileEntryT(data[
-            offset + i * FileEntryT.entrySize(): offset + (i + 1) * FileEntryT.entrySize()]))
-    scanDummyEntry(fileList)
+    with extract_stats.stage("savefilesystem.getFileList") as record:
+        offset = fsHeader.fileTableOff
+        if fsHeader.tableInDataRegion:
+            data = getAllocatedList(dataRegion, fsHeader.blockSize, fat,
+                                    fsHeader.fileTableBlockIndex, fsHeader.fileTableBlockCount)
+        else:
+            data = partitionImage
+        fileList = getEntryList(data, offset, FileEntryT)
+        scanDummyEntry(fileList)
+        record.bytes += len(fileList) * FileEntryT.entrySize()
     return fileList
 
 
@@ -403,50 +660,195 @@ def getTdbFileList(fsHeader, dataRegion, fat):
 
 
 def verifyHashTable(hashTable, entryList):
-    for i in range(len(hashTable)):
-        current = hashTable[i]
-        while current != 0:
-            if entryList[current].getHash() % len(hashTable) != i:
-                print("Warning: wrong bucket")
-            current = entryList[current].nextCollision
+    with extract_stats.stage("savefilesystem.verifyHashTable",
+                             len(hashTable) * 4):
+        for i in range(len(hashTable)):
+            current = hashTable[i]
+            while current != 0:
+                if entryList[current].getHash() % len(hashTable) != i:
+                    print("Warning: wrong bucket")
+                current = entryList[current].nextCollision
+
+
+def walkTree(dirList, fileList):
+    """ Walks the directory tree from the root without recursion
+
+     Yields (path, entry, index) for every directory and file in the order
+     they are extracted. path is relative to the root, and entry is an item
+     of dirList or fileList. An entry that is reached twice is skipped.
+    """
+    dirSeen = bytearray(len(dirList))
+    fileSeen = bytearray(len(fileList))
+    stack = [(True, 1, "")]
+    while stack:
+        isDir, i, parent = stack.pop()
+        if isDir:
+            if dirSeen[i]:
+                print("Warning: directory %d visited twice" % i)
+                continue
+            dirSeen[i] = 1
+            entry = dirList[i]
+            path = os.path.join(parent, entry.getName())
+            yield (path, entry, i)
+
+            # Sibling directories come after the subdirectories and files
+            if entry.nextIndex != 0:
+                stack.append((True, entry.nextIndex, parent))
+            if entry.firstFileIndex != 0:
+                stack.append((False, entry.firstFileIndex, path))
+            if entry.firstDirIndex != 0:
+                stack.append((True, entry.firstDirIndex, path))
+        else:
+            if fileSeen[i]:
+                print("Warning: file %d visited twice" % i)
+                continue
+            fileSeen[i] = 1
+            entry = fileList[i]
+            yield (os.path.join(parent, entry.getName()), entry, i)
+
+            if entry.nextIndex != 0:
+                stack.append((False, entry.nextIndex, parent))
+
+
+def createOutputFile(path):
+    """ Opens a new output file, replacing any existing file at path
+
+     The old file is removed rather than truncated, as it may be a hardlink
+     shared with a blob store.
+    """
+    if os.path.lexists(path):
+        os.remove(path)
+    return open(path, 'wb')
+
+
+def isDirEntry(entry):
+    return isinstance(entry, (DirEntry, TdbDirEntry))
 
 
 def extractAll(dirList, fileList, outputDir, fileDumper):
-    def ExtractDir(i, parent):
-        if outputDir is not None:
-            dir = os.path.join(outputDir, parent, dirList[i].getName())
-            if not os.path.isdir(dir):
-                os.mkdir(dir)
-
-        # Extracts subdirectories
-        if dirList[i].firstDirIndex != 0:
-            ExtractDir(dirList[i].firstDirIndex,
-                       os.path.join(parent, dirList[i].getName()))
-
-        # Extract files
-        if dirList[i].firstFileIndex != 0:
-            ExtractFile(dirList[i].firstFileIndex,
-                        os.path.join(parent, dirList[i].getName()))
-
-        # Extract sibling directories
-        if dirList[i].nextIndex != 0:
-            ExtractDir(dirList[i].nextIndex, parent)
-
-    def ExtractFile(i, parent):
-        full_name = os.path.join(parent, fileList[i].getName())
+    for path, entry, i in walkTree(dirList, fileList):
+        if isDirEntry(entry):
+            if outputDir is not None:
+                dir = os.path.join(outputDir, path)
+                if not os.path.isdir(dir):
+                    os.mkdir(dir)
+            continue
+
         if outputDir is not None:
-            file = open(os.path.join(outputDir, full_name), 'wb')
+            file = createOutputFile(os.path.join(outputDir, path))
         else:
             file = None
 
-        fileDumper(fileList[i], file, i)
+        fileDumper(entry, file, i)
 
         if file is not None:
             file.close()
 
-        # Extract sibling files
-        if fileList[i].nextIndex != 0:
-            ExtractFile(fileList[i].nextIndex, parent)
 
-    # Extracts ALL
-    ExtractDir(1, "")
+class FileSystem(object):
+    """ Path based access to a parsed filesystem
+
+     A path like "/a/b/file" is resolved one component at a time through the
+     directory and file hash tables, so a lookup follows one collision chain
+     per component instead of walking the tree. In title databases, file
+     names are title IDs in 16-digit hex. Extdata files have no content in
+     the data region, so they can be looked up but not read. Reading does
+     not mark FAT blocks as visited.
+    """
+
+    def __init__(self, fsHeader, dataRegion, fat, dirList, fileList,
+                 dirHashTable, fileHashTable, isExtdata=False):
+        self.blockSize = fsHeader.blockSize
+        self.dataRegion = dataRegion
+        self.fat = fat
+        self.dirList = dirList
+        self.fileList = fileList
+        self.dirHashTable = dirHashTable
+        self.fileHashTable = fileHashTable
+        self.isExtdata = isExtdata
+        self.isTdb = isinstance(dirList[0], TdbDirEntry)
+
+    def findEntry(self, entryList, hashTable, parentIndex, name):
+        """ Gets the index of a child entry by name, or 0 if there is none """
+        if len(hashTable) == 0:
+            return 0
+        if self.isTdb:
+            try:
+                key = int(name, 16)
+            except ValueError:
+                return 0
+            hash = getTitleIdHash(parentIndex, key)
+        else:
+            key = name.encode()
+            if len(key) > 16:
+                return 0
+            key = key.ljust(16, b'\0')
+            hash = getNameHash(parentIndex, key)
+
+        i = hashTable[hash % len(hashTable)]
+        for _ in range(len(entryList)):  # bounds a looping chain
+            if i == 0:
+                break
+            entry = entryList[i]
+            if entry.parentIndex == parentIndex and not entry.isDummy and \
+                    (entry.titleId if self.isTdb else entry.name) == key:
+                return i
+            i = entry.nextCollision
+        return 0
+
+    def lookup(self, path):
+        """ Resolves a path to (is directory, entry index)
+
+         Raises FileNotFoundError or NotADirectoryError.
+        """
+        names = [name for name in path.split('/') if name != '']
+        index = 1  # root
+        for depth, name in enumerate(names):
+            dirIndex = self.findEntry(
+                self.dirList, self.dirHashTable, index, name)
+            if dirIndex != 0:
+                index = dirIndex
+                continue
+            fileIndex = self.findEntry(
+                self.fileList, self.fileHashTable, index, name)
+            if fileIndex == 0:
+                raise FileNotFoundError(path)
+            if depth != len(names) - 1:
+                raise NotADirectoryError(path)
+            return (False, fileIndex)
+        return (True, index)
+
+    def stat(self, path):
+        """ Gets the directory or file entry of a path """
+        isDir, index = self.lookup(path)
+        return self.dirList[index] if isDir else self.fileList[index]
+
+    def listdir(self, path="/"):
+        """ Lists the names of subdirectories and files in a directory """
+        isDir, index = self.lookup(path)
+        if not isDir:
+            raise NotADirectoryError(path)
+        names = []
+        for entryList, i in ((self.dirList, self.dirList[index].firstDirIndex),
+                             (self.fileList, self.dirList[index].firstFileIndex)):
+            for _ in range(len(entryList)):  # bounds a looping chain
+                if i == 0:
+                    break
+                names.append(entryList[i].getName())
+                i = entryList[i].nextIndex
+        return names
+
+    def read(self, path):
+        """ Reads the whole content of a file """
+        isDir, index = self.lookup(path)
+        if isDir:
+            raise IsADirectoryError(path)
+        if self.isExtdata:
+            raise ValueError("extdata file content is in a separate subfile")
+        entry = self.fileList[index]
+        result = bytearray()
+        if entry.size != 0:
+            for pos, size in getChainRanges(self.fat, entry.blockIndex,
+                                            self.blockSize, entry.size, False):
+                result.extend(self.dataRegion[pos: pos + size])
+        return bytes(result)
@@ -1,6 +1,11 @@
 import hashlib
 import struct
 import io
+import time
+import collections
+import concurrent.futures
+
+import extract_stats
 
 try:
     from Cryptodome.Hash import CMAC
@@ -11,14 +16,209 @@ except:
     from Crypto.Cipher import AES
     from Crypto.Util import Counter
 
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
 
-def DecryptSdFile(file, filePath, key):
+def getSdCounter(filePath):
+    """ Gets the initial AES-CTR counter of a file from its path on SD """
     utf16Path = (filePath + '\0').encode(encoding='utf_16_le')
     pathHash = hashlib.sha256(utf16Path).digest()
     low = pathHash[0:16]
     high = pathHash[16:32]
     mixed = bytes([a ^ b for (a, b) in zip(low, high)])
     ctra, ctrb = struct.unpack(">QQ", mixed)
-    ctr = Counter.new(128, initial_value=(ctra << 64) | ctrb)
-    decrypted = AES.new(key, AES.MODE_CTR, counter=ctr).decrypt(file.read())
-    return io.BytesIO(decrypted)
+    return (ctra << 64) | ctrb
+
+
+def ctrDecryptPycryptodome(key, counter, data):
+    ctr = Counter.new(128, initial_value=counter)
+    return AES.new(key, AES.MODE_CTR, counter=ctr).decrypt(data)
+
+
+def ctrDecryptCryptography(key, counter, data):
+    decryptor = Cipher(algorithms.AES(key),
+                       modes.CTR(counter.to_bytes(16, 'big'))).decryptor()
+    return decryptor.update(data) + decryptor.finalize()
+
+
+ctrBackends = [("pycryptodome", ctrDecryptPycryptodome)]
+if Cipher is not None:
+    ctrBackends.append(("cryptography", ctrDecryptCryptography))
+
+ctrBackend = None
+
+
+def getCtrBackend():
+    """ Picks the fastest available AES-CTR implementation
+
+     Each backend decrypts 1 MiB once, on first use. The winner is kept for
+     the rest of the process. Returns (name, function).
+    """
+    global ctrBackend
+    if ctrBackend is None:
+        if len(ctrBackends) == 1:
+            ctrBackend = ctrBackends[0]
+        else:
+            sample = bytes(0x100000)
+            timings = []
+            for backend in ctrBackends:
+                start = time.perf_counter()
+                backend[1](bytes(0x10), 0, sample)
+                timings.append((time.perf_counter() - start, backend))
+            ctrBackend = min(timings, key=lambda timing: timing[0])[1]
+    return ctrBackend
+
+
+def ctrDecrypt(key, counter, data):
+    """ Decrypts data starting at the given counter with the fastest backend """
+    return getCtrBackend()[1](key, counter % (1 << 128), data)
+
+
+class SdFile(io.RawIOBase):
+    """ Seekable file object that decrypts an encrypted SD file on the fly
+
+     The file is decrypted in windows of windowSize bytes, aligned to the
+     window size, and the last few windows are kept. The many small reads of
+     DPFS and IVFC levels are served from them, instead of each setting up
+     AES-CTR for a few blocks. The CTR counter is worked out from the
+     position of each window. With threadCount > 1, the threadCount windows
+     after the one being read are read ahead and decrypted on a thread pool,
+     and recorded as the "sd_decrypt.readAhead" stage. The AES backends
+     release the GIL, so reading through the file scales with cores.
+    """
+
+    windowSize = 0x100000
+
+    def __init__(self, file, key, counter, threadCount=1):
+        super().__init__()
+        self.file = file
+        self.key = key
+        self.counter = counter
+        self.pos = 0
+        # Window index -> decrypted window, or its Future while read ahead
+        self.windows = collections.OrderedDict()
+        if threadCount > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(threadCount)
+            self.readAheadCount = threadCount
+        else:
+            self.executor = None
+            self.readAheadCount = 0
+        # The windows read ahead, and one or two being read by each thread
+        # that reads from the file
+        self.windowCount = self.readAheadCount + 2 * max(threadCount, 1)
+        # Reading ahead starts again from windows past this one
+        self.readAheadEnd = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.file.seek(0, io.SEEK_END) + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+        return self.pos
+
+    def decrypt(self, blockPos, encrypted, stageName="sd_decrypt"):
+        """ Decrypts data that starts at an AES block boundary """
+        with extract_stats.stage(stageName, len(encrypted)):
+            return ctrDecrypt(self.key, self.counter + blockPos // 0x10,
+                              encrypted)
+
+    def loadWindow(self, index, readAhead=False):
+        """ Reads a window and decrypts it, or starts decrypting it on the pool
+
+         Returns None past the end of the file.
+        """
+        pos = index * self.windowSize
+        self.file.seek(pos, io.SEEK_SET)
+        encrypted = self.file.read(self.windowSize)
+        if len(encrypted) == 0:
+            return None
+        if readAhead:
+            window = self.executor.submit(self.decrypt, pos, encrypted,
+                                          "sd_decrypt.readAhead")
+        else:
+            window = memoryview(self.decrypt(pos, encrypted))
+        self.windows[index] = window
+        while len(self.windows) > self.windowCount:
+            self.evictWindow()
+        return window
+
+    def evictWindow(self):
+        """ Drops the least recently used window that has been read
+
+         Windows read ahead are only dropped when all the others are, so
+         they are not lost before the reads get to them.
+        """
+        for index, window in self.windows.items():
+            if not isinstance(window, concurrent.futures.Future):
+                del self.windows[index]
+                return
+        _, window = self.windows.popitem(last=False)
+        window.cancel()
+
+    def getWindow(self, index):
+        """ Gets the decrypted content of a window, decrypting it if needed """
+        window = self.windows.get(index)
+        if window is not None:
+            self.windows.move_to_end(index)
+        else:
+            window = self.loadWindow(index)
+            if window is None:
+                return memoryview(b'')
+
+        # Only read ahead while reading into windows past the ones read so
+        # far, so going back to earlier windows does not evict the others
+        if index >= self.readAheadEnd - self.readAheadCount:
+            for ahead in range(max(index + 1, self.readAheadEnd),
+                               index + 1 + self.readAheadCount):
+                if ahead not in self.windows and \
+                        self.loadWindow(ahead, True) is None:
+                    break
+            self.readAheadEnd = max(self.readAheadEnd,
+                                    index + 1 + self.readAheadCount)
+
+        if isinstance(window, concurrent.futures.Future):
+            window = memoryview(window.result())
+            if index in self.windows:
+                self.windows[index] = window
+        return window
+
+    def readinto(self, buffer):
+        buffer = memoryview(buffer).cast('B')
+        total = 0
+        while total < len(buffer):
+            index, offset = divmod(self.pos, self.windowSize)
+            chunk = self.getWindow(index)[offset: offset + len(buffer) - total]
+            if len(chunk) == 0:
+                break  # end of file
+            buffer[total: total + len(chunk)] = chunk
+            total += len(chunk)
+            self.pos += len(chunk)
+        return total
+
+    def close(self):
+        if not self.closed:
+            self.windows.clear()
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+            self.file.close()
+        super().close()
+
+
+def DecryptSdFile(file, filePath, key, threadCount=1):
+    return SdFile(file, key, getSdCounter(filePath), threadCount)
@@ -0,0 +1,572 @@
+import hashlib
+import os
+import os.path
+import struct
+
+import sd_decrypt
+
+
+def align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+def packSelectorBits(bits):
+    """ Packs DPFS selector bits into u32 words, most significant bit first """
+    output = bytearray()
+    for i in range(0, len(bits), 32):
+        word = 0
+        for j, bit in enumerate(bits[i: i + 32]):
+            word |= bit << (31 - j)
+        output += struct.pack('<I', word)
+    return bytes(output)
+
+
+def hashLevel(data, blockSize):
+    """ Gets the IVFC hashes of data, padding the last block with zeros """
+    output = bytearray()
+    for pos in range(0, len(data), blockSize):
+        chunk = data[pos: pos + blockSize]
+        output += hashlib.sha256(
+            chunk + b'\0' * (blockSize - len(chunk))).digest()
+    return bytes(output)
+
+
+def pickSelectorBits(rng, count, pattern):
+    """ Gets DPFS selector bits
+
+     pattern is "zero" or "one" for a constant selector, "runs" for random
+     runs of up to 20 equal bits, or "random" for independent bits.
+    """
+    if pattern == "zero":
+        return [0] * count
+    if pattern == "one":
+        return [1] * count
+    if pattern == "runs":
+        bits = []
+        bit = 0
+        while len(bits) < count:
+            bits += [bit] * rng.randint(1, 20)
+            bit ^= 1
+        return bits[:count]
+    if pattern == "random":
+        return [rng.randint(0, 1) for _ in range(count)]
+    raise ValueError("unknown selector pattern %s" % pattern)
+
+
+def mirrorLevel(rng, active, bits, blockSize):
+    """ Builds a DPFS level pair with active data placed by the selector """
+    pair = [bytearray(rng.randbytes(len(active))),
+            bytearray(rng.randbytes(len(active)))]
+    for i, bit in enumerate(bits):
+        pair[bit][i * blockSize: (i + 1) * blockSize] = \
+            active[i * blockSize: (i + 1) * blockSize]
+    return bytes(pair[0]) + bytes(pair[1])
+
+
+def buildPartition(rng, l4, external, ivfcLog=(9, 9, 9, 12),
+                   dpfsLog=(2, 7, 9), selector="random", poison=()):
+    """ Wraps an image in IVFC and DPFS levels
+
+     Returns (partition descriptor, partition). With external, IVFC level 4
+     is stored after the DPFS levels instead of inside them. The level 4
+     blocks listed in poison are corrupted after hashing, so they read back
+     as unhashed.
+    """
+    blockSizes = [2 ** x for x in ivfcLog]
+    l3 = hashLevel(l4, blockSizes[3])
+    l2 = hashLevel(l3, blockSizes[2])
+    l1 = hashLevel(l2, blockSizes[1])
+    masterHash = hashLevel(l1, blockSizes[0])
+
+    l4 = bytearray(l4)
+    for block in poison:
+        if block * blockSizes[3] < len(l4):
+            l4[block * blockSizes[3]] ^= 0xFF
+    l4 = bytes(l4)
+
+    # IVFC levels, which are the content of DPFS level 3
+    l1Off = 0
+    l2Off = align(l1Off + len(l1), blockSizes[1])
+    l3Off = align(l2Off + len(l2), blockSizes[2])
+    l4Off = align(l3Off + len(l3), blockSizes[3])
+    ivfc = bytearray(l3Off + len(l3) if external else l4Off + len(l4))
+    ivfc[l1Off: l1Off + len(l1)] = l1
+    ivfc[l2Off: l2Off + len(l2)] = l2
+    ivfc[l3Off: l3Off + len(l3)] = l3
+    if not external:
+        ivfc[l4Off: l4Off + len(l4)] = l4
+
+    dpfsBlockSizes = [2 ** x for x in dpfsLog]
+    l3Bits = pickSelectorBits(
+        rng, (len(ivfc) + dpfsBlockSizes[2] - 1) // dpfsBlockSizes[2],
+        selector)
+    l2Active = packSelectorBits(l3Bits)
+    l2Bits = pickSelectorBits(
+        rng, (len(l2Active) + dpfsBlockSizes[1] - 1) // dpfsBlockSizes[1],
+        selector)
+    l1Active = packSelectorBits(l2Bits)
+    l1Selector = rng.randint(0, 1)
+
+    dpfsL3 = mirrorLevel(rng, ivfc, l3Bits, dpfsBlockSizes[2])
+    dpfsL2 = mirrorLevel(rng, l2Active, l2Bits, dpfsBlockSizes[1])
+    l1Pair = [rng.randbytes(len(l1Active)), rng.randbytes(len(l1Active))]
+    l1Pair[l1Selector] = l1Active
+    dpfsL1 = l1Pair[0] + l1Pair[1]
+
+    dpfsL1Off = 0
+    dpfsL2Off = align(dpfsL1Off + len(dpfsL1), 0x10)
+    dpfsL3Off = align(dpfsL2Off + len(dpfsL2), 0x1000)
+    externalOff = align(dpfsL3Off + len(dpfsL3), 0x1000)
+    part = bytearray(externalOff + len(l4) if external
+                     else dpfsL3Off + len(dpfsL3))
+    part[dpfsL1Off: dpfsL1Off + len(dpfsL1)] = dpfsL1
+    part[dpfsL2Off: dpfsL2Off + len(dpfsL2)] = dpfsL2
+    part[dpfsL3Off: dpfsL3Off + len(dpfsL3)] = dpfsL3
+    if external:
+        part[externalOff: externalOff + len(l4)] = l4
+
+    difi = struct.pack('<IIQQQQQQBB2xQ', 0x49464944, 0x00010000,
+                       0x44, 0x78, 0xBC, 0x50, 0x10C, len(masterHash),
+                       1 if external else 0, l1Selector,
+                       externalOff if external else 0)
+    ivfcDescriptor = struct.pack(
+        '<IIQQQI4xQQI4xQQI4xQQI4xQ', 0x43465649, 0x00020000, len(masterHash),
+        l1Off, len(l1), ivfcLog[0], l2Off, len(l2), ivfcLog[1],
+        l3Off, len(l3), ivfcLog[2], l4Off, len(l4), ivfcLog[3], 0x78)
+    dpfsDescriptor = struct.pack(
+        '<IIQQI4xQQI4xQQI4x', 0x53465044, 0x00010000,
+        dpfsL1Off, len(l1Active), dpfsLog[0],
+        dpfsL2Off, len(l2Active), dpfsLog[1],
+        dpfsL3Off, len(ivfc), dpfsLog[2])
+    descriptor = difi + ivfcDescriptor + dpfsDescriptor + masterHash
+    return descriptor.ljust(align(len(descriptor), 0x10), b'\0'), bytes(part)
+
+
+def getNameHash(parentIndex, name):
+    """ Same as savefilesystem.getNameHash, for a 16-byte name """
+    hash = parentIndex ^ 0x091A2B3C
+    for i in range(4):
+        hash = ((hash >> 1) | (hash << 31)) & 0xFFFFFFFF
+        hash ^= struct.unpack('<I', name[i * 4: i * 4 + 4])[0]
+    return hash
+
+
+def getTitleIdHash(parentIndex, titleId):
+    """ Same as savefilesystem.getTitleIdHash """
+    hash = parentIndex ^ 0x091A2B3C
+    hash = ((hash >> 1) | (hash << 31)) & 0xFFFFFFFF
+    hash ^= titleId & 0xFFFFFFFF
+    hash = ((hash >> 1) | (hash << 31)) & 0xFFFFFFFF
+    hash ^= titleId >> 32
+    return hash
+
+
+class FATBuilder(object):
+    """ Allocates block chains and builds the FAT for them
+
+     Blocks are 0-based here and 1-based in the FAT. With fragment, each
+     chain takes random free blocks, in order or shuffled, so it is split
+     into many runs; otherwise chains take the first free blocks.
+    """
+
+    def __init__(self, rng, blockCount, fragment):
+        self.rng = rng
+        self.fragment = fragment
+        # (u index, u flag, v index, v flag) of each FAT node
+        self.nodes = [(0, 0, 0, 0)] * (blockCount + 1)
+        self.free = list(range(blockCount))
+
+    def allocate(self, count):
+        """ Allocates a chain of count blocks and gets its blocks in order """
+        if count == 0:
+            return []
+        if count > len(self.free):
+            raise ValueError("image too small for the files")
+        if self.fragment:
+            blocks = sorted(self.rng.sample(self.free, count))
+            if self.rng.random() < 0.5:
+                self.rng.shuffle(blocks)
+            picked = set(blocks)
+            self.free = [block for block in self.free if block not in picked]
+        else:
+            blocks = self.free[:count]
+            self.free = self.free[count:]
+        self.link(blocks)
+        return blocks
+
+    def link(self, blocks):
+        runs = []
+        for block in blocks:
+            if runs and runs[-1][1] + 1 == block:
+                runs[-1][1] = block
+            else:
+                runs.append([block, block])
+
+        previous = 0
+        for i, (first, last) in enumerate(runs):
+            start, end = first + 1, last + 1
+            next = runs[i + 1][0] + 1 if i + 1 < len(runs) else 0
+            self.nodes[start] = (previous, 1 if i == 0 else 0,
+                                 next, 1 if end > start else 0)
+            if end > start:
+                self.nodes[start + 1] = (start, 1, end, 0)
+                self.nodes[end] = (start, 1, end, 0)
+            previous = start
+
+    def build(self):
+        """ Chains the remaining blocks as free blocks and packs the FAT """
+        if self.free:
+            self.link(self.free)
+            self.nodes[0] = (0, 0, self.free[0] + 1, 0)
+        return b''.join(struct.pack('<II', u | (uFlag << 31), v | (vFlag << 31))
+                        for u, uFlag, v, vFlag in self.nodes)
+
+
+def buildTree(files):
+    """ Lays out a directory tree for {path: content}
+
+     Returns (dirs, files) as lists of dicts, where the root is dirs[0] and
+     entry indices are list indices + 1.
+    """
+    dirs = [{"name": b'', "parent": 0, "dirs": [], "files": []}]
+    dirIndices = {"": 0}
+    fileList = []
+    for path in sorted(files):
+        names = path.strip('/').split('/')
+        current = ""
+        for name in names[:-1]:
+            child = current + '/' + name
+            if child not in dirIndices:
+                dirs.append({"name": name.encode(),
+                             "parent": dirIndices[current],
+                             "dirs": [], "files": []})
+                dirIndices[child] = len(dirs) - 1
+                dirs[dirIndices[current]]["dirs"].append(len(dirs) - 1)
+            current = child
+        fileList.append({"name": names[-1].encode(),
+                         "parent": dirIndices[current],
+                         "content": files[path]})
+        dirs[dirIndices[current]]["files"].append(len(fileList) - 1)
+    return dirs, fileList
+
+
+def buildHashTable(hashes, bucketCount):
+    """ Gets the buckets and the nextCollision of each entry (0 is dummy) """
+    buckets = [0] * bucketCount
+    collisions = [0] * (len(hashes) + 1)
+    for i, hash in enumerate(hashes):
+        index = i + 1
+        bucket = hash % bucketCount
+        if buckets[bucket] == 0:
+            buckets[bucket] = index
+        else:
+            current = buckets[bucket]
+            while collisions[current] != 0:
+                current = collisions[current]
+            collisions[current] = index
+    return buckets, collisions
+
+
+def getNextSibling(siblings, index):
+    position = siblings.index(index)
+    return siblings[position + 1] if position + 1 < len(siblings) else 0
+
+
+def buildFileSystem(rng, files, kind="save", hasData=False, blockSize=0x200,
+                    spareBlocks=8, fragment=False, dirBuckets=7,
+                    fileBuckets=11):
+    """ Builds a SAVE, VSXE or BDRI image
+
+     kind is "save" for {path: content}, "extdata" for {path: unique ID}
+     (the content is in separate DIFF files) or "titledb" for
+     {title ID: content}. With hasData, the entry tables are stored in the
+     image and the data region is returned separately, as for a DISA with
+     partition B. Returns (image, data region or None).
+    """
+    if kind == "titledb":
+        dirs = [{"name": b'', "parent": 0, "dirs": [], "files": []}]
+        fileList = []
+        for titleId in sorted(files):
+            fileList.append({"titleId": titleId, "parent": 0,
+                             "content": files[titleId]})
+            dirs[0]["files"].append(len(fileList) - 1)
+        dirEntrySize, fileEntrySize = 0x20, 0x2C
+    else:
+        dirs, fileList = buildTree(files)
+        dirEntrySize, fileEntrySize = 0x28, 0x30
+
+    # One dummy entry and two spare entries per table
+    dirSlots = len(dirs) + 3
+    fileSlots = len(fileList) + 3
+    dirTableBlocks = (dirSlots * dirEntrySize + blockSize - 1) // blockSize
+    fileTableBlocks = (fileSlots * fileEntrySize + blockSize - 1) // blockSize
+
+    contentBlocks = 0
+    if kind != "extdata":
+        contentBlocks = sum((len(file["content"]) + blockSize - 1) // blockSize
+                            for file in fileList)
+    blockCount = contentBlocks + spareBlocks
+    if not hasData:
+        blockCount += dirTableBlocks + fileTableBlocks
+
+    fat = FATBuilder(rng, blockCount, fragment)
+    dataRegion = bytearray(rng.randbytes(blockCount * blockSize))
+    if not hasData:
+        dirBlocks = fat.allocate(dirTableBlocks)
+        fileBlocks = fat.allocate(fileTableBlocks)
+
+    for file in fileList:
+        if kind == "extdata":
+            file["block"] = 0x80000000
+            continue
+        content = file["content"]
+        blocks = fat.allocate((len(content) + blockSize - 1) // blockSize)
+        file["block"] = blocks[0] if blocks else 0x80000000
+        for i, block in enumerate(blocks):
+            chunk = content[i * blockSize: (i + 1) * blockSize]
+            dataRegion[block * blockSize: block * blockSize + len(chunk)] = \
+                chunk
+
+    if kind == "titledb":
+        dirHashes = [getTitleIdHash(0, 0)]
+        fileHashes = [getTitleIdHash(file["parent"] + 1, file["titleId"])
+                      for file in fileList]
+    else:
+        dirHashes = [getNameHash(dir["parent"] + 1 if i != 0 else 0,
+                                 dir["name"].ljust(16, b'\0'))
+                     for i, dir in enumerate(dirs)]
+        fileHashes = [getNameHash(file["parent"] + 1,
+                                  file["name"].ljust(16, b'\0'))
+                      for file in fileList]
+    dirHashTable, dirCollisions = buildHashTable(dirHashes, dirBuckets)
+    fileHashTable, fileCollisions = buildHashTable(fileHashes, fileBuckets)
+
+    dirTable = bytearray(dirSlots * dirEntrySize)
+    fileTable = bytearray(fileSlots * fileEntrySize)
+    dirTable[0: dirEntrySize] = struct.pack(
+        '<II%dxI' % (dirEntrySize - 0xC), len(dirs) + 1, dirSlots, 0)
+    fileTable[0: fileEntrySize] = struct.pack(
+        '<II%dxI' % (fileEntrySize - 0xC), len(fileList) + 1, fileSlots, 0)
+
+    for i, dir in enumerate(dirs):
+        index = i + 1
+        parent = dir["parent"] + 1 if i != 0 else 0
+        next = getNextSibling([sub + 1 for sub in dirs[dir["parent"]]["dirs"]],
+                              index) if i != 0 else 0
+        firstDir = dir["dirs"][0] + 1 if dir["dirs"] else 0
+        firstFile = dir["files"][0] + 1 if dir["files"] else 0
+        if kind == "titledb":
+            raw = struct.pack('<IIIIIIII', parent, next, firstDir, firstFile,
+                              0, 0, 0, dirCollisions[index])
+        else:
+            raw = struct.pack('<I16sIIIII', parent, dir["name"], next,
+                              firstDir, firstFile, 0, dirCollisions[index])
+        dirTable[index * dirEntrySize: (index + 1) * dirEntrySize] = raw
+
+    for i, file in enumerate(fileList):
+        index = i + 1
+        next = getNextSibling(
+            [sub + 1 for sub in dirs[file["parent"]]["files"]], index)
+        if kind == "titledb":
+            raw = struct.pack('<IQIIIQIII', file["parent"] + 1,
+                              file["titleId"], next, 0, file["block"],
+                              len(file["content"]), 0, 0,
+                              fileCollisions[index])
+        elif kind == "extdata":
+            raw = struct.pack('<I16sI4xIQII', file["parent"] + 1, file["name"],
+                              next, file["block"], file["content"], 0,
+                              fileCollisions[index])
+        else:
+            raw = struct.pack('<I16sI4xIQII', file["parent"] + 1, file["name"],
+                              next, file["block"], len(file["content"]), 1,
+                              fileCollisions[index])
+        fileTable[index * fileEntrySize: (index + 1) * fileEntrySize] = raw
+
+    if not hasData:
+        for table, blocks in ((dirTable, dirBlocks), (fileTable, fileBlocks)):
+            for i, block in enumerate(blocks):
+                dataRegion[block * blockSize: (block + 1) * blockSize] = \
+                    table[i * blockSize: (i + 1) * blockSize].ljust(
+                        blockSize, b'\0')
+
+    fatRaw = fat.build()
+
+    headerSize = 0x138 if kind == "extdata" else 0x20
+    fsHeaderOff = headerSize
+    dirHashTableOff = align(fsHeaderOff + 0x68, 8)
+    fileHashTableOff = align(dirHashTableOff + 4 * dirBuckets, 8)
+    fatOff = align(fileHashTableOff + 4 * fileBuckets, 8)
+    end = fatOff + len(fatRaw)
+    if hasData:
+        dirTableOff = align(end, 8)
+        fileTableOff = align(dirTableOff + len(dirTable), 8)
+        end = fileTableOff + len(fileTable)
+        dataRegionOff = 0
+    else:
+        dataRegionOff = align(end, blockSize)
+        end = dataRegionOff + len(dataRegion)
+
+    image = bytearray(end)
+    if kind == "extdata":
+        image[0: headerSize] = struct.pack(
+            '<IIQQIIQIIII256s', 0x45585356, 0x00030000, fsHeaderOff,
+            len(image) // blockSize, blockSize, 0, 0, 0, 0, 0, 0, b'/recent')
+    elif kind == "titledb":
+        image[0: headerSize] = struct.pack(
+            '<IIQQII', 0x49524442, 0x00030000, fsHeaderOff,
+            len(image) // blockSize, blockSize, 0)
+    else:
+        image[0: headerSize] = struct.pack(
+            '<IIQQII', 0x45564153, 0x00040000, fsHeaderOff,
+            len(image) // blockSize, blockSize, 0)
+
+    fsHeader = struct.pack('<IIQI4xQI4xQI4xQI4x', 0, blockSize,
+                           dirHashTableOff, dirBuckets,
+                           fileHashTableOff, fileBuckets,
+                           fatOff, blockCount, dataRegionOff, blockCount)
+    if hasData:
+        fsHeader += struct.pack('<QI4xQI4x', dirTableOff, dirSlots - 2,
+                                fileTableOff, fileSlots - 1)
+    else:
+        fsHeader += struct.pack('<III4xIII4x',
+                                dirBlocks[0], dirTableBlocks, dirSlots - 2,
+                                fileBlocks[0], fileTableBlocks, fileSlots - 1)
+    image[fsHeaderOff: fsHeaderOff + 0x68] = fsHeader
+    image[dirHashTableOff: dirHashTableOff + 4 * dirBuckets] = \
+        struct.pack('<%dI' % dirBuckets, *dirHashTable)
+    image[fileHashTableOff: fileHashTableOff + 4 * fileBuckets] = \
+        struct.pack('<%dI' % fileBuckets, *fileHashTable)
+    image[fatOff: fatOff + len(fatRaw)] = fatRaw
+    if hasData:
+        image[dirTableOff: dirTableOff + len(dirTable)] = dirTable
+        image[fileTableOff: fileTableOff + len(fileTable)] = fileTable
+        return bytes(image), bytes(dataRegion)
+    image[dataRegionOff: dataRegionOff + len(dataRegion)] = dataRegion
+    return bytes(image), None
+
+
+def buildDisa(rng, files, hasData=False, selector="random", poison=(),
+              **fsOptions):
+    """ Builds a DISA file holding a SAVE image of {path: content}
+
+     With hasData, the file data is stored in partition B, which has an
+     external IVFC level 4, and poison lists the level 4 blocks of it to
+     corrupt. Other keyword arguments go to buildFileSystem.
+    """
+    image, dataRegion = buildFileSystem(rng, files, "save", hasData,
+                                        **fsOptions)
+    descriptorA, partA = buildPartition(rng, image, False, selector=selector)
+    if hasData:
+        descriptorB, partB = buildPartition(rng, dataRegion, True,
+                                            selector=selector, poison=poison)
+    else:
+        descriptorB, partB = b'', b''
+
+    table = descriptorA + descriptorB
+    secTableOff = 0x200
+    priTableOff = align(secTableOff + len(table), 0x100)
+    partAOff = align(priTableOff + len(table), 0x1000)
+    partBOff = align(partAOff + len(partA), 0x1000)
+    disa = bytearray(partBOff + len(partB))
+    activeTable = rng.randint(0, 1)
+    tableOff, inactiveOff = (priTableOff, secTableOff) if activeTable == 0 \
+        else (secTableOff, priTableOff)
+    disa[tableOff: tableOff + len(table)] = table
+    disa[inactiveOff: inactiveOff + len(table)] = rng.randbytes(len(table))
+    disa[partAOff: partAOff + len(partA)] = partA
+    disa[partBOff: partBOff + len(partB)] = partB
+    disa[0x100:0x200] = struct.pack(
+        '<III4xQQQQQQQQQQQB3x32s116x', 0x41534944, 0x00040000,
+        2 if hasData else 1, secTableOff, priTableOff, len(table),
+        0, len(descriptorA), len(descriptorA), len(descriptorB),
+        partAOff, len(partA), partBOff if hasData else 0, len(partB),
+        activeTable, hashlib.sha256(table).digest())
+    return bytes(disa)
+
+
+def buildDiff(rng, content, uniqueId=0, external=False, selector="random",
+              poison=()):
+    """ Builds a DIFF file holding content """
+    descriptor, part = buildPartition(rng, content, external,
+                                      selector=selector, poison=poison)
+    secTableOff = 0x200
+    priTableOff = align(secTableOff + len(descriptor), 0x10)
+    partOff = align(priTableOff + len(descriptor), 0x1000)
+    diff = bytearray(partOff + len(part))
+    activeTable = rng.randint(0, 1)
+    tableOff, inactiveOff = (priTableOff, secTableOff) if activeTable == 0 \
+        else (secTableOff, priTableOff)
+    diff[tableOff: tableOff + len(descriptor)] = descriptor
+    diff[inactiveOff: inactiveOff + len(descriptor)] = \
+        rng.randbytes(len(descriptor))
+    diff[partOff:] = part
+    diff[0x100:0x200] = struct.pack(
+        '<IIQQQQQI32sQ164x', 0x46464944, 0x00030000,
+        secTableOff, priTableOff, len(descriptor), partOff, len(part),
+        activeTable, hashlib.sha256(descriptor).digest(), uniqueId)
+    return bytes(diff)
+
+
+def writeExtdata(rng, extdataDir, files, selector="random", poison=(),
+                 **fsOptions):
+    """ Writes an extdata directory holding {path: content}
+
+     Subfile 1 is the VSXE filesystem and every file is a DIFF subfile, of
+     which about half have an external IVFC level 4. poison applies to
+     every file subfile. Other keyword arguments go to buildFileSystem.
+    """
+    uniqueIds = {}
+    for i, path in enumerate(sorted(files)):
+        uniqueIds[path] = 1000 + 7 * i
+    image, _ = buildFileSystem(rng, uniqueIds, "extdata", **fsOptions)
+
+    def writeSubfile(fileId, diff):
+        subDir = os.path.join(extdataDir, "%08x" % (fileId // 126))
+        os.makedirs(subDir, exist_ok=True)
+        with open(os.path.join(subDir, "%08x" % (fileId % 126)), 'wb') as file:
+            file.write(diff)
+
+    writeSubfile(1, buildDiff(rng, image, selector=selector))
+    # File entry i + 1 is stored in subfile i + 2, in buildTree order
+    _, fileList = buildTree(uniqueIds)
+    paths = {uniqueId: path for path, uniqueId in uniqueIds.items()}
+    for i, file in enumerate(fileList):
+        writeSubfile(i + 2, buildDiff(
+            rng, files[paths[file["content"]]], uniqueId=file["content"],
+            external=rng.random() < 0.5, selector=selector, poison=poison))
+
+
+def buildTitleDb(rng, titles, magic="TICK", selector="random", poison=(),
+                 **fsOptions):
+    """ Builds a title database DIFF holding a BDRI image of {title ID: content}
+
+     magic is the pre-header magic: "TICK", or "NAND" or "TEMP", which have
+     0x70 more bytes of pre-header.
+    """
+    image, _ = buildFileSystem(rng, titles, "titledb", **fsOptions)
+    preHeader = struct.pack('<4sIII', magic.encode(), 1, 2, 3)
+    if magic != "TICK":
+        preHeader += rng.randbytes(0x70)
+    return buildDiff(rng, preHeader + image, selector=selector, poison=poison)
+
+
+def encryptSdFile(data, key, sdPath):
+    """ Encrypts a file as it is stored at sdPath on SD (CTR is symmetric) """
+    return sd_decrypt.ctrDecrypt(key, sd_decrypt.getSdCounter(sdPath), data)
+
+
+def randomFiles(rng, count, maxSize, depth=2):
+    """ Gets {path: content} of random files in up to depth subdirectories """
+    files = {}
+    for i in range(count):
+        dirs = ['d%d' % rng.randint(0, 3)
+                for _ in range(rng.randint(0, depth))]
+        files['/'.join([''] + dirs + ['f%03d.bin' % i])] = \
+            rng.randbytes(rng.randint(0, maxSize))
+    return files
+
+
+def randomTitles(rng, count, maxSize):
+    """ Gets {title ID: content} of random title database entries """
+    return {0x0004000000000000 | (rng.getrandbits(24) << 8):
+            rng.randbytes(rng.randint(1, maxSize)) for _ in range(count)}